@@ -0,0 +1,62 @@
+"""
+Approximate nearest-neighbour indexes for very large files, built with FAISS when it is installed
+"""
+import os
+from typing import List, Optional, Tuple
+import numpy as np
+from backend.config import settings
+
+try:
+    import faiss
+except ImportError:  # FAISS is optional; retrieval falls back to a brute-force scan
+    faiss = None
+
+# Below this many chunks a brute-force scan is already only a few milliseconds
+INDEX_THRESHOLD = 20000
+IVF_MAX_LISTS = 256
+PQ_SUBQUANTIZERS = 16
+PQ_BITS = 8
+IVF_NPROBE = 8
+
+def index_path(file_id: int) -> str:
+    """Location of a file's IVF-PQ index."""
+    return os.path.join(settings.INDEX_DIR, f"{file_id}.ivfpq.faiss")
+
+def build_index(file_id: int, matrix: np.ndarray) -> bool:
+    """Train and save an IVF-PQ index over L2-normalized rows. Returns False if none was built."""
+    if faiss is None or matrix.shape[0] < INDEX_THRESHOLD:
+        return False
+
+    n, d = matrix.shape
+    vectors = np.ascontiguousarray(matrix, dtype=np.float32)
+    # Subquantizers must split the dimension evenly; each vector is stored as m bytes
+    m = next(m for m in (PQ_SUBQUANTIZERS, 8, 4, 2, 1) if d % m == 0)
+    nlist = min(IVF_MAX_LISTS, int(np.sqrt(n)))
+
+    # Inner product on normalized vectors is cosine similarity
+    quantizer = faiss.IndexFlatIP(d)
+    index = faiss.IndexIVFPQ(quantizer, d, nlist, m, PQ_BITS, faiss.METRIC_INNER_PRODUCT)
+    index.train(vectors)
+    index.add(vectors)
+    faiss.write_index(index, index_path(file_id))
+    return True
+
+def load_index(file_id: int):
+    """Read a file's IVF-PQ index, or None if it has none."""
+    path = index_path(file_id)
+    if faiss is None or not os.path.exists(path):
+        return None
+    index = faiss.read_index(path)
+    index.nprobe = IVF_NPROBE
+    return index
+
+def search_index(index, query_vec: np.ndarray, top_k: int) -> List[Tuple[int, float]]:
+    """Top-k (row index, similarity) pairs for a normalized query."""
+    scores, ids = index.search(np.ascontiguousarray(query_vec, dtype=np.float32)[None, :], top_k)
+    return [(int(idx), float(score)) for idx, score in zip(ids[0], scores[0]) if idx >= 0]
+
+def remove_index(file_id: int):
+    """Delete a file's IVF-PQ index from disk if it exists."""
+    path = index_path(file_id)
+    if os.path.exists(path):
+        os.remove(path)
\ No newline at end of file
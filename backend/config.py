@@ -13,14 +13,24 @@ class Settings:
     # File Upload Configuration
     UPLOAD_DIR: str = os.getenv("UPLOAD_DIR", "./uploads")
     MAX_FILE_SIZE: int = int(os.getenv("MAX_FILE_SIZE", "10485760"))  # 10MB
+    # Search indexes derived from uploads; kept apart so nothing in the upload directory is ever loaded as an index
+    INDEX_DIR: str = os.getenv("INDEX_DIR", "./indexes")
     
     # RAG Configuration
     CHUNK_SIZE: int = int(os.getenv("CHUNK_SIZE", "512"))
     CHUNK_OVERLAP: int = int(os.getenv("CHUNK_OVERLAP", "50"))
     MAX_CHUNKS_FOR_CONTEXT: int = int(os.getenv("MAX_CHUNKS_FOR_CONTEXT", "5"))
+    # "simple" ranks with TF-IDF and answers from templates; "embeddings" uses the Hugging Face embedding and LLM APIs
+    RAG_BACKEND: str = os.getenv("RAG_BACKEND", "simple")
+    # Weight of the session's earlier queries when retrieving for a follow-up (0 retrieves on the query alone)
+    HISTORY_WEIGHT: float = float(os.getenv("HISTORY_WEIGHT", "0.5"))
     
     # Model Configuration
     EMBEDDING_MODEL: str = os.getenv("EMBEDDING_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
+    EMBEDDING_BATCH_SIZE: int = int(os.getenv("EMBEDDING_BATCH_SIZE", "64"))
+    EMBEDDING_CONCURRENCY: int = int(os.getenv("EMBEDDING_CONCURRENCY", "4"))
+    EMBEDDING_MAX_WAIT_MS: float = float(os.getenv("EMBEDDING_MAX_WAIT_MS", "10"))
+    EMBEDDING_ONNX_DIR: str = os.getenv("EMBEDDING_ONNX_DIR", "")
     LLM_MODEL: str = os.getenv("LLM_MODEL", "microsoft/DialoGPT-medium")
     
     # Hugging Face API URLs
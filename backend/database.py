@@ -1,4 +1,6 @@
-from sqlalchemy import create_engine
+from alembic.migration import MigrationContext
+from alembic.operations import Operations
+from sqlalchemy import Column, create_engine, event, inspect
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 import os
@@ -9,6 +11,15 @@ load_dotenv()
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./chatbot.db")
 
 engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False} if "sqlite" in DATABASE_URL else {})
+
+if "sqlite" in DATABASE_URL:
+    @event.listens_for(engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        # WAL lets readers run alongside a writer; NORMAL sync skips an fsync per commit
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.close()
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 Base = declarative_base()
@@ -20,5 +31,29 @@ def get_db():
     finally:
         db.close()
 
-def create_tables():
-    Base.metadata.create_all(bind=engine)
\ No newline at end of file
+def create_tables(bind=engine):
+    """Create missing tables, then bring tables from earlier versions up to the current models.
+    
+    Any failure propagates, so startup stops instead of running against a half-upgraded schema.
+    """
+    Base.metadata.create_all(bind=bind)
+    
+    with bind.begin() as conn:
+        inspector = inspect(conn)
+        operations = Operations(MigrationContext.configure(conn))
+        
+        # create_all doesn't alter existing tables, so add any columns they are missing;
+        # Alembic renders each type and server default through the dialect's DDL compiler
+        for table in Base.metadata.sorted_tables:
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    operations.add_column(table.name, Column(
+                        column.name, column.type, nullable=column.nullable,
+                        server_default=column.server_default.arg if column.server_default is not None else None
+                    ))
+        
+        # create_all skips tables that already exist, so add any indexes they are missing
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(bind=conn, checkfirst=True)
\ No newline at end of file
@@ -1,9 +1,36 @@
 import os
+import re
 import hashlib
-from typing import List, Tuple
-from docx import Document
+import zipfile
+from typing import List, Optional, Tuple
+from lxml import etree
 from backend.config import settings
 
+try:
+    import blake3
+except ImportError:  # BLAKE3 is optional; content hashes fall back to SHA-256
+    blake3 = None
+
+# Stored with each upload, since hashes from SHA-256 and BLAKE3 never match each other
+CONTENT_HASH_ALGO = "blake3" if blake3 is not None else "sha256"
+
+_WORD_RE = re.compile(r'\S+')
+
+_W = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+_W_BODY = _W + "body"
+_W_P = _W + "p"
+_W_R = _W + "r"
+_W_T = _W + "t"
+_W_BR = _W + "br"
+_W_TBL = _W + "tbl"
+_W_TR = _W + "tr"
+_W_TC = _W + "tc"
+_W_HYPERLINK = _W + "hyperlink"
+# Run elements other than w:t and w:br that stand for a character
+_RUN_CHARACTERS = {_W + "tab": "\t", _W + "ptab": "\t", _W + "cr": "\n", _W + "noBreakHyphen": "-"}
+_OFFICE_DOCUMENT_REL = "http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument"
+_PACKAGE_RELS = "{http://schemas.openxmlformats.org/package/2006/relationships}Relationship"
+
 class DocumentProcessor:
     def __init__(self):
         self.chunk_size = settings.CHUNK_SIZE
@@ -12,25 +39,33 @@ class DocumentProcessor:
     def extract_text_from_docx(self, file_path: str) -> str:
         """Extract text from a Word document."""
         try:
-            doc = Document(file_path)
-            text_content = []
-            
-            # Extract text from paragraphs
-            for paragraph in doc.paragraphs:
-                if paragraph.text.strip():
-                    text_content.append(paragraph.text.strip())
+            paragraphs = []
+            tables = []
+            with zipfile.ZipFile(file_path) as archive, archive.open(_main_document_part(archive)) as xml:
+                # Stream the body instead of building python-docx objects for every paragraph and run
+                for _, element in etree.iterparse(xml, events=("end",), tag=(_W_P, _W_TBL), resolve_entities=False):
+                    parent = element.getparent()
+                    # Nested elements are read with their enclosing table
+                    if parent is None or parent.tag != _W_BODY:
+                        continue
+                    
+                    if element.tag == _W_P:
+                        paragraph_text = _paragraph_text(element).strip()
+                        if paragraph_text:
+                            paragraphs.append(paragraph_text)
+                    else:
+                        for row in _table_rows(element):
+                            row_text = [cell_text for cell_text in row if cell_text]
+                            if row_text:
+                                tables.append(" | ".join(row_text))
+                    
+                    # Drop finished body elements so memory stays flat on large documents
+                    element.clear()
+                    while element.getprevious() is not None:
+                        del parent[0]
             
-            # Extract text from tables
-            for table in doc.tables:
-                for row in table.rows:
-                    row_text = []
-                    for cell in row.cells:
-                        if cell.text.strip():
-                            row_text.append(cell.text.strip())
-                    if row_text:
-                        text_content.append(" | ".join(row_text))
-            
-            return "\n\n".join(text_content)
+            # Paragraphs first, then tables, as python-docx's doc.paragraphs and doc.tables gave them
+            return "\n\n".join(paragraphs + tables)
         except Exception as e:
             raise Exception(f"Error extracting text from document: {str(e)}")
     
@@ -39,42 +74,119 @@ class DocumentProcessor:
         if not text:
             return []
         
-        chunks = []
-        words = text.split()
-        
-        if len(words) <= self.chunk_size:
+        # Short documents: a bounded split stops just past chunk_size words (same whitespace rules as \S+)
+        if len(text.split(None, self.chunk_size)) <= self.chunk_size:
             return [(text, 0, len(text))]
         
-        start_idx = 0
-        char_start = 0
+        # Find word positions in one pass so chunks can be sliced straight from the text
+        starts = []
+        ends = []
+        for match in _WORD_RE.finditer(text):
+            starts.append(match.start())
+            ends.append(match.end())
+        
+        chunks = []
+        step = max(1, self.chunk_size - self.chunk_overlap)
         
-        while start_idx < len(words):
-            end_idx = min(start_idx + self.chunk_size, len(words))
-            chunk_words = words[start_idx:end_idx]
-            chunk_text = " ".join(chunk_words)
+        for start_idx in range(0, len(starts), step):
+            end_idx = min(start_idx + self.chunk_size, len(starts))
             
             # Calculate character positions
-            char_end = char_start + len(chunk_text)
+            char_start = starts[start_idx]
+            char_end = ends[end_idx - 1]
             
-            chunks.append((chunk_text, char_start, char_end))
+            # Chunk text is single-spaced as before; the offsets still cover the original span
+            chunks.append((" ".join(text[char_start:char_end].split()), char_start, char_end))
             
-            # Move start position with overlap
-            if end_idx >= len(words):
+            if end_idx >= len(starts):
                 break
-            
-            start_idx = end_idx - self.chunk_overlap
-            char_start = char_end - len(" ".join(words[end_idx - self.chunk_overlap:end_idx]))
         
         return chunks
     
     def calculate_content_hash(self, text: str) -> str:
-        """Calculate SHA-256 hash of content for deduplication."""
-        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+        """Calculate a 64-character hex hash of content for deduplication."""
+        hasher = new_content_hasher()
+        hasher.update(text.encode('utf-8'))
+        return hasher.hexdigest()
+    
+    def calculate_file_hash(self, file_path: str) -> str:
+        """Hash a file's raw bytes the way uploads are hashed while being received."""
+        hasher = new_content_hasher()
+        with open(file_path, "rb") as f:
+            while block := f.read(1 << 20):
+                hasher.update(block)
+        return hasher.hexdigest()
     
-    def process_document(self, file_path: str) -> Tuple[str, List[Tuple[str, int, int]], str]:
-        """Process a document and return text, chunks, and content hash."""
+    def process_document(self, file_path: str,
+                         content_hash: Optional[str] = None) -> Tuple[str, List[Tuple[str, int, int]], str]:
+        """Process a document and return text, chunks, and content hash.
+        
+        Pass content_hash when the file was already hashed while being received;
+        otherwise the file is hashed here.
+        """
         text = self.extract_text_from_docx(file_path)
         chunks = self.chunk_text(text)
-        content_hash = self.calculate_content_hash(text)
+        if content_hash is None:
+            content_hash = self.calculate_file_hash(file_path)
         
-        return text, chunks, content_hash
\ No newline at end of file
+        return text, chunks, content_hash
+
+def new_content_hasher():
+    """Incremental hasher for deduplication: BLAKE3 when installed (about 3x SHA-256's throughput), else SHA-256."""
+    return blake3.blake3() if blake3 is not None else hashlib.sha256()
+
+def _main_document_part(archive: zipfile.ZipFile) -> str:
+    """Name of the package's main document part, normally word/document.xml."""
+    rels = etree.fromstring(archive.read("_rels/.rels"))
+    for rel in rels.iter(_PACKAGE_RELS):
+        if rel.get("Type") == _OFFICE_DOCUMENT_REL:
+            return rel.get("Target").lstrip("/")
+    return "word/document.xml"
+
+def _paragraph_text(p) -> str:
+    """Text of a w:p element, with tabs and breaks mapped as python-docx's Paragraph.text maps them."""
+    parts = []
+    for child in p.iterchildren(_W_R, _W_HYPERLINK):
+        runs = (child,) if child.tag == _W_R else child.iterchildren(_W_R)
+        for run in runs:
+            for item in run:
+                if item.tag == _W_T:
+                    parts.append(item.text or "")
+                elif item.tag == _W_BR:
+                    # Page and column breaks carry no text
+                    if item.get(_W + "type", "textWrapping") == "textWrapping":
+                        parts.append("\n")
+                elif item.tag in _RUN_CHARACTERS:
+                    parts.append(_RUN_CHARACTERS[item.tag])
+    return "".join(parts)
+
+def _table_rows(tbl) -> List[List[str]]:
+    """Stripped cell texts of each row of a w:tbl, one entry per grid column.
+    
+    Spanned and vertically merged cells repeat their text like python-docx's row.cells,
+    but the grid is laid out once per table rather than once per row.
+    """
+    grid = tbl.find(_W + "tblGrid")
+    column_count = len(grid.findall(_W + "gridCol")) if grid is not None else 0
+    rows = list(tbl.iterchildren(_W_TR))
+    cells = []
+    for tr in rows:
+        for tc in tr.iterchildren(_W_TC):
+            grid_span = 1
+            v_merge = None
+            tc_pr = tc.find(_W + "tcPr")
+            if tc_pr is not None:
+                span = tc_pr.find(_W + "gridSpan")
+                if span is not None:
+                    grid_span = int(span.get(_W + "val"))
+                merge = tc_pr.find(_W + "vMerge")
+                if merge is not None:
+                    v_merge = merge.get(_W + "val", "continue")
+            for span_idx in range(grid_span):
+                if v_merge == "continue":
+                    cells.append(cells[-column_count])
+                elif span_idx > 0:
+                    cells.append(cells[-1])
+                else:
+                    cells.append("\n".join(_paragraph_text(p) for p in tc.iterchildren(_W_P)).strip())
+    return [cells[i * column_count:(i + 1) * column_count] for i in range(len(rows))]
\ No newline at end of file
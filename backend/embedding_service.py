@@ -1,9 +1,39 @@
+import asyncio
 import json
+import random
+import time
+import itertools
 import requests
-from typing import List, Optional, Tuple
+import httpx
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import List, Optional, Tuple, Union
 import numpy as np
-from sklearn.metrics.pairwise import cosine_similarity
 from backend.config import settings
+from backend.simkernel import dot_similarities
+from backend.onnx_embedder import load_embedder
+
+# Shared client for embedding requests made from async handlers
+_async_client = httpx.AsyncClient(timeout=60.0, limits=httpx.Limits(max_keepalive_connections=20))
+
+async def close_client():
+    """Close the shared async HTTP client's pooled connections."""
+    await _async_client.aclose()
+
+# Largest int8 magnitude used when quantizing; each row is scaled so its largest component maps here
+QUANT_SCALE = 127
+
+def top_k_indices(scores: np.ndarray, k: int) -> np.ndarray:
+    """Indices of the k highest scores, best first.
+    
+    Partitions in O(N) and sorts only the k winners instead of the whole array.
+    """
+    k = min(k, scores.shape[0])
+    if k <= 0:
+        return np.empty(0, dtype=np.intp)
+    top = np.argpartition(-scores, k - 1)[:k]
+    return top[np.argsort(-scores[top])]
 
 class EmbeddingService:
     def __init__(self):
@@ -11,72 +41,283 @@ class EmbeddingService:
         self.embedding_model = settings.EMBEDDING_MODEL
         self.headers = {"Authorization": f"Bearer {self.api_key}"}
         self.embedding_url = f"{settings.HF_INFERENCE_URL}/{self.embedding_model}"
+        self.batch_size = settings.EMBEDDING_BATCH_SIZE
+        self.concurrency = settings.EMBEDDING_CONCURRENCY
+        # Pooled keep-alive connections, so batches after the first skip the TCP and TLS handshakes
+        self._session = requests.Session()
+        self._session.mount("https://", HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=max(self.concurrency, 1),
+            max_retries=Retry(
+                total=3, backoff_factor=0.2, status_forcelist=[429, 502, 503, 504],
+                allowed_methods=frozenset({"POST"}), raise_on_status=False
+            )
+        ))
+        # Local ONNX Runtime model, when one is configured and installed
+        self.local_embedder = load_embedder(settings.EMBEDDING_ONNX_DIR)
     
-    def get_embedding(self, text: str) -> Optional[List[float]]:
+    def get_embedding(self, text: str) -> Optional[np.ndarray]:
         """Get embedding for a single text using Hugging Face API."""
+        return self._post_batch([text])[0]
+    
+    def get_embeddings_batch(self, texts: List[str]) -> List[Optional[np.ndarray]]:
+        """Get embeddings for multiple texts, sending batches concurrently.
+        
+        Each embedding is a float32 row view into its batch's contiguous matrix.
+        """
+        batches = [texts[i:i + self.batch_size] for i in range(0, len(texts), self.batch_size)]
+        # Local inference is CPU-bound and already uses every core per batch, so run batches in turn
+        if len(batches) <= 1 or self.concurrency <= 1 or self.local_embedder is not None:
+            return list(itertools.chain.from_iterable(self._post_batch(batch) for batch in batches))
+        
+        # Requests are I/O-bound, so threads overlap the round-trips
+        results = [None] * len(batches)
+        with ThreadPoolExecutor(max_workers=min(self.concurrency, len(batches))) as executor:
+            futures = {
+                executor.submit(self._post_batch_with_jitter, batch): idx
+                for idx, batch in enumerate(batches)
+            }
+            for future in as_completed(futures):
+                results[futures[future]] = future.result()
+        
+        # Reassemble in original order
+        return list(itertools.chain.from_iterable(results))
+    
+    def _post_batch_with_jitter(self, texts: List[str]) -> List[Optional[np.ndarray]]:
+        """Post a batch after a short random delay so concurrent batches don't hit the API at once."""
+        time.sleep(random.uniform(0, 0.05))
+        return self._post_batch(texts)
+    
+    def _post_batch(self, texts: List[str]) -> List[Optional[np.ndarray]]:
+        """Get embeddings for a batch of texts with a single API request."""
+        if self.local_embedder is not None:
+            return self._embed_locally(texts)
         if not self.api_key:
             raise ValueError("HF_API_KEY not provided")
         
-        # Use the correct format for sentence transformers
-        payload = {"inputs": [text]}  # Note: wrapped in list
+        # Sentence transformers accept a list of inputs and return one vector per input
+        payload = {"inputs": texts, "options": {"wait_for_model": True}}
         
         try:
-            response = requests.post(
+            response = self._session.post(
                 self.embedding_url,
                 headers=self.headers,
                 json=payload,
-                timeout=30
+                timeout=60
             )
             
             if response.status_code == 200:
-                result = response.json()
-                # Handle different response formats
-                if isinstance(result, list) and len(result) > 0:
-                    if isinstance(result[0], list):
-                        return result[0]  # Direct embedding
-                    elif isinstance(result[0], dict) and 'embedding' in result[0]:
-                        return result[0]['embedding']
-                return result
+                embeddings = self._parse_batch_response(response.json(), len(texts))
+                if len(texts) > 1 and all(embedding is None for embedding in embeddings):
+                    # The endpoint didn't answer the batch with one vector per text; ask one text at a time
+                    return [self._post_batch([text])[0] for text in texts]
+                return embeddings
             else:
                 print(f"Embedding API error: {response.status_code} - {response.text}")
-                return None
+                return [None] * len(texts)
         except Exception as e:
-            print(f"Error getting embedding: {str(e)}")
-            return None
-    
-    def get_embeddings_batch(self, texts: List[str]) -> List[Optional[List[float]]]:
-        """Get embeddings for multiple texts."""
-        embeddings = []
-        for text in texts:
-            embedding = self.get_embedding(text)
-            embeddings.append(embedding)
-        return embeddings
-    
-    def find_similar_chunks(self, query_embedding: List[float], 
-                          chunk_embeddings: List[List[float]], 
-                          top_k: int = 5) -> List[Tuple[int, float]]:
-        """Find most similar chunks using cosine similarity."""
-        if not query_embedding or not chunk_embeddings:
-            return []
+            print(f"Error getting embeddings: {str(e)}")
+            return [None] * len(texts)
+    
+    def _embed_locally(self, texts: List[str]) -> List[Optional[np.ndarray]]:
+        """Get embeddings for a batch of texts from the local ONNX model."""
+        try:
+            return list(self.local_embedder.embed(texts))
+        except Exception as e:
+            print(f"Error getting embeddings: {str(e)}")
+            return [None] * len(texts)
+    
+    async def aget_embedding(self, text: str) -> Optional[np.ndarray]:
+        """Get embedding for a single text without blocking the event loop."""
+        if self.local_embedder is not None:
+            return await asyncio.get_running_loop().run_in_executor(None, self.get_embedding, text)
+        return (await self._apost_batch([text]))[0]
+    
+    async def aget_embeddings_batch(self, texts: List[str]) -> List[Optional[np.ndarray]]:
+        """Get embeddings for multiple texts, with the batch requests in flight together on the shared async client."""
+        if self.local_embedder is not None:
+            return await asyncio.get_running_loop().run_in_executor(None, self.get_embeddings_batch, texts)
+        
+        batches = [texts[i:i + self.batch_size] for i in range(0, len(texts), self.batch_size)]
+        semaphore = asyncio.Semaphore(max(self.concurrency, 1))
+        
+        async def post(batch: List[str]) -> List[Optional[np.ndarray]]:
+            async with semaphore:
+                return await self._apost_batch(batch)
+        
+        # gather keeps batch order, so the results line up with texts
+        results = await asyncio.gather(*(post(batch) for batch in batches))
+        return list(itertools.chain.from_iterable(results))
+    
+    async def _apost_batch(self, texts: List[str]) -> List[Optional[np.ndarray]]:
+        """Async counterpart of _post_batch."""
+        if not self.api_key:
+            raise ValueError("HF_API_KEY not provided")
+        
+        payload = {"inputs": texts, "options": {"wait_for_model": True}}
         
         try:
-            query_vec = np.array(query_embedding).reshape(1, -1)
-            chunk_vecs = np.array(chunk_embeddings)
+            response = await _async_client.post(self.embedding_url, headers=self.headers, json=payload)
             
-            similarities = cosine_similarity(query_vec, chunk_vecs)[0]
+            if response.status_code == 200:
+                embeddings = self._parse_batch_response(response.json(), len(texts))
+                if len(texts) > 1 and all(embedding is None for embedding in embeddings):
+                    singles = await asyncio.gather(*(self._apost_batch([text]) for text in texts))
+                    return [single[0] for single in singles]
+                return embeddings
+            else:
+                print(f"Embedding API error: {response.status_code} - {response.text}")
+                return [None] * len(texts)
+        except Exception as e:
+            print(f"Error getting embeddings: {str(e)}")
+            return [None] * len(texts)
+    
+    def _parse_batch_response(self, result, count: int) -> List[Optional[np.ndarray]]:
+        """Turn an embedding API response for count texts into float32 rows."""
+        # Handle different response formats
+        vectors = None
+        if isinstance(result, list) and len(result) == count:
+            if all(isinstance(item, list) for item in result):
+                vectors = result  # Direct embeddings
+            elif all(isinstance(item, dict) and 'embedding' in item for item in result):
+                vectors = [item['embedding'] for item in result]
+        if count == 1 and isinstance(result, list) and result and isinstance(result[0], (int, float)):
+            vectors = [result]  # Single flat embedding
+        
+        if vectors is not None:
+            # Parse straight into one contiguous float32 matrix for the batch
+            matrix = np.asarray(vectors, dtype=np.float32)
+            if matrix.ndim == 2:
+                return list(matrix)
+        print(f"Unexpected embedding API response for batch of {count} texts")
+        return [None] * count
+    
+    def normalize_embedding(self, embedding: np.ndarray) -> np.ndarray:
+        """L2-normalize an embedding so cosine similarity becomes a dot product."""
+        vec = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vec)
+        return vec / norm if norm > 0 else vec
+    
+    def normalize_embeddings(self, matrix: np.ndarray) -> np.ndarray:
+        """L2-normalize every row of an embedding matrix in one vectorized pass."""
+        matrix = np.array(matrix, dtype=np.float32)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        np.divide(matrix, norms, out=matrix, where=norms > 0)
+        return matrix
+    
+    def batch_similarities(self, query_embedding: np.ndarray, chunk_matrix: np.ndarray,
+                           row_scales: Optional[np.ndarray] = None) -> np.ndarray:
+        """Cosine similarity of a query with every row of a chunk matrix, in one kernel call.
+        
+        Rows of chunk_matrix are expected to be L2-normalized (see normalize_embedding),
+        either as float32 or as int8 with per-row scales from quantize_embeddings.
+        int8 matrices without row_scales use the fixed 1/QUANT_SCALE step.
+        """
+        query_vec = self.normalize_embedding(query_embedding)
+        matrix = np.asarray(chunk_matrix)
+        
+        if matrix.dtype != np.int8:
+            return dot_similarities(np.ascontiguousarray(matrix, dtype=np.float32), query_vec)
+        
+        # Quantize the query with its own scale so it uses the full int8 range
+        query_scale = QUANT_SCALE / max(float(np.abs(query_vec).max()), 1e-12)
+        query_q = np.round(query_vec * query_scale).astype(np.int16)
+        raw = dot_similarities(matrix, query_q).astype(np.float32)
+        if row_scales is not None:
+            return raw * np.asarray(row_scales, dtype=np.float32) / np.float32(query_scale)
+        return raw / np.float32(QUANT_SCALE * query_scale)
+    
+    def find_similar_chunks(self, query_embedding: np.ndarray, 
+                          chunk_matrix: np.ndarray, 
+                          top_k: int = 5,
+                          row_scales: Optional[np.ndarray] = None) -> List[Tuple[int, float]]:
+        """Find most similar chunks using cosine similarity (see batch_similarities)."""
+        if query_embedding is None or len(query_embedding) == 0 or len(chunk_matrix) == 0:
+            return []
+        
+        try:
+            similarities = self.batch_similarities(query_embedding, chunk_matrix, row_scales)
             
             # Get top-k most similar chunks
-            top_indices = np.argsort(similarities)[::-1][:top_k]
+            top_indices = top_k_indices(similarities, top_k)
             
             return [(int(idx), float(similarities[idx])) for idx in top_indices]
         except Exception as e:
             print(f"Error finding similar chunks: {str(e)}")
             return []
     
-    def embedding_to_string(self, embedding: List[float]) -> str:
-        """Convert embedding to JSON string for storage."""
-        return json.dumps(embedding)
+    def quantize_embeddings(self, matrix: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Quantize embeddings to int8 with one scale per row, so each row uses the full int8 range.
+        
+        Returns (quantized, scales) where row i is approximately quantized[i] * scales[i].
+        """
+        matrix = np.asarray(matrix, dtype=np.float32)
+        max_abs = np.abs(matrix).max(axis=1)
+        scales = np.where(max_abs > 0, max_abs / QUANT_SCALE, 1.0).astype(np.float32)
+        quantized = np.round(matrix / scales[:, None]).astype(np.int8)
+        return quantized, scales
+    
+    def embedding_to_bytes(self, embedding: np.ndarray) -> bytes:
+        """Convert embedding to raw float32 bytes for storage."""
+        return np.ascontiguousarray(embedding, dtype=np.float32).tobytes()
+    
+    def bytes_to_embedding(self, embedding_bytes: Union[bytes, str]) -> np.ndarray:
+        """Convert stored float32 bytes back to an embedding.
+        
+        Rows stored before embeddings were kept as bytes hold JSON text, which is parsed instead.
+        """
+        if isinstance(embedding_bytes, str):
+            return np.asarray(json.loads(embedding_bytes), dtype=np.float32)
+        return np.frombuffer(embedding_bytes, dtype=np.float32)
+
+class BatchingEmbedder:
+    """Coalesces concurrent single-text embedding requests into batched API calls."""
+    
+    def __init__(self, embedding_service: EmbeddingService):
+        self.embedding_service = embedding_service
+        self.max_batch = settings.EMBEDDING_BATCH_SIZE
+        self.max_wait = settings.EMBEDDING_MAX_WAIT_MS / 1000
+        self._loop = None
+        self._queue = None
+        self._worker = None
+    
+    async def embed(self, text: str) -> Optional[np.ndarray]:
+        """Embed one text, sharing the API request with any queries that arrive within max_wait."""
+        loop = asyncio.get_running_loop()
+        # The queue and worker belong to one event loop; start them on first use
+        if self._loop is not loop or self._worker.done():
+            self._loop = loop
+            self._queue = asyncio.Queue()
+            self._worker = loop.create_task(self._run())
+        
+        future = loop.create_future()
+        await self._queue.put((text, future))
+        return await future
     
-    def string_to_embedding(self, embedding_str: str) -> List[float]:
-        """Convert JSON string back to embedding."""
-        return json.loads(embedding_str)
\ No newline at end of file
+    async def _run(self):
+        """Drain the queue in batches of up to max_batch texts."""
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            
+            texts = [text for text, _ in batch]
+            try:
+                embeddings = await self.embedding_service.aget_embeddings_batch(texts)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            
+            for (_, future), embedding in zip(batch, embeddings):
+                if not future.done():
+                    future.set_result(embedding)
\ No newline at end of file
@@ -1,15 +1,40 @@
-import requests
+import re
+import httpx
 from typing import List, Optional
 from backend.config import settings
 
+# Models tried in order when the preferred one fails
+FALLBACK_MODELS = [
+    "microsoft/DialoGPT-medium",
+    "gpt2",
+    "distilgpt2"
+]
+
+# Shared client so TCP/TLS connections to the inference API are reused across turns
+_client = httpx.AsyncClient(timeout=60.0, limits=httpx.Limits(max_keepalive_connections=20))
+
+async def close_client():
+    """Close the shared HTTP client's pooled connections."""
+    await _client.aclose()
+
 class LLMService:
+    # Constant system instruction, built once rather than on every prompt
+    SYSTEM_PROMPT = (
+        "You are a helpful AI assistant that answers questions based on provided documents. "
+        "Use only the information from the given context to answer questions. "
+        "If the context doesn't contain enough information to answer the question, "
+        "say so politely and suggest what additional information might be needed."
+    )
+    ROLE_LABELS = {'user': 'Human'}
+    
     def __init__(self):
         self.api_key = settings.HF_API_KEY
         self.model = settings.LLM_MODEL
         self.headers = {"Authorization": f"Bearer {self.api_key}"}
         self.llm_url = f"{settings.HF_INFERENCE_URL}/{self.model}"
+        self._preferred_model = FALLBACK_MODELS[0]
     
-    def generate_response(self, query: str, context_chunks: List[str], 
+    async def generate_response(self, query: str, context_chunks: List[str], 
                          conversation_history: List[dict] = None) -> Optional[str]:
         """Generate response using context and conversation history."""
         if not self.api_key:
@@ -21,36 +46,27 @@ class LLMService:
         # Create prompt with context and conversation history
         prompt = self._create_prompt(query, context, conversation_history)
         
-        # Try different models if the current one fails
-        models_to_try = [
-            "microsoft/DialoGPT-medium",
-            "gpt2",
-            "distilgpt2"
-        ]
+        payload = {
+            "inputs": prompt,
+            "parameters": {
+                "max_new_tokens": 200,
+                "temperature": 0.7,
+                "do_sample": True,
+                "top_p": 0.9,
+                "repetition_penalty": 1.1,
+                "return_full_text": False
+            }
+        }
+        
+        # Try the last model that answered first, then the remaining fallbacks
+        models_to_try = [self._preferred_model] + [m for m in FALLBACK_MODELS if m != self._preferred_model]
         
         for model in models_to_try:
-            model_url = f"{self.headers.get('Authorization', '').replace('Bearer ', '') and f'https://api-inference.huggingface.co/models/{model}' or ''}"
-            if not model_url:
-                continue
-                
-            payload = {
-                "inputs": prompt,
-                "parameters": {
-                    "max_new_tokens": 200,
-                    "temperature": 0.7,
-                    "do_sample": True,
-                    "top_p": 0.9,
-                    "repetition_penalty": 1.1,
-                    "return_full_text": False
-                }
-            }
-            
             try:
-                response = requests.post(
-                    f"https://api-inference.huggingface.co/models/{model}",
+                response = await _client.post(
+                    f"{settings.HF_INFERENCE_URL}/{model}",
                     headers=self.headers,
-                    json=payload,
-                    timeout=60
+                    json=payload
                 )
                 
                 if response.status_code == 200:
@@ -69,6 +85,7 @@ class LLMService:
                         generated_text = generated_text[len(prompt):].strip()
                     
                     if generated_text and len(generated_text.strip()) > 10:
+                        self._preferred_model = model
                         return generated_text.strip()
                 else:
                     print(f"LLM API error for {model}: {response.status_code} - {response.text}")
@@ -83,30 +100,22 @@ class LLMService:
     
     def _create_prompt(self, query: str, context: str, conversation_history: List[dict] = None) -> str:
         """Create a well-formatted prompt for the LLM."""
-        prompt_parts = []
-        
-        # System instruction
-        prompt_parts.append(
-            "You are a helpful AI assistant that answers questions based on provided documents. "
-            "Use only the information from the given context to answer questions. "
-            "If the context doesn't contain enough information to answer the question, "
-            "say so politely and suggest what additional information might be needed."
-        )
+        prompt_parts = [self.SYSTEM_PROMPT]
         
         # Add context if available
         if context:
             prompt_parts.append(f"\nContext from documents:\n{context}")
         
-        # Add conversation history
+        # Add conversation history (last 5 messages for context)
         if conversation_history:
             prompt_parts.append("\nConversation history:")
-            for msg in conversation_history[-5:]:  # Last 5 messages for context
-                role = "Human" if msg['message_type'] == 'user' else "Assistant"
-                prompt_parts.append(f"{role}: {msg['content']}")
+            prompt_parts.extend(
+                f"{self.ROLE_LABELS.get(msg['message_type'], 'Assistant')}: {msg['content']}"
+                for msg in conversation_history[-5:]
+            )
         
         # Add current query
-        prompt_parts.append(f"\nHuman: {query}")
-        prompt_parts.append("Assistant:")
+        prompt_parts.append(f"\nHuman: {query}\nAssistant:")
         
         return "\n".join(prompt_parts)
     
@@ -118,11 +127,13 @@ class LLMService:
         
         # Simple keyword-based response as fallback
         relevant_info = []
-        query_words = query.lower().split()
+        # Deduplicated, and short words like "a"/"is" would match almost any chunk
+        query_words = {word for word in query.lower().split() if len(word) > 2}
+        # One alternation scans each chunk once for all words, without lowercasing a copy
+        word_pattern = re.compile("|".join(map(re.escape, query_words)), re.IGNORECASE) if query_words else None
         
         for chunk in context_chunks[:3]:  # Use top 3 chunks
-            chunk_lower = chunk.lower()
-            if any(word in chunk_lower for word in query_words):
+            if word_pattern is not None and word_pattern.search(chunk):
                 relevant_info.append(chunk[:200] + "..." if len(chunk) > 200 else chunk)
         
         if relevant_info:
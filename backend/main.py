@@ -3,20 +3,25 @@ import uuid
 import shutil
 from typing import List, Optional
 from fastapi import FastAPI, File, UploadFile, Depends, HTTPException, Form
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, ORJSONResponse
+from sqlalchemy import or_, select
 from sqlalchemy.orm import Session
 from pydantic import BaseModel
 
-from backend.database import get_db, create_tables
+from backend.database import SessionLocal, get_db, create_tables
 from backend.models import UploadedFile, ChatSession, ChatMessage
-from backend.document_processor import DocumentProcessor
-from backend.simple_rag import SimpleRAGService
+from backend.document_processor import DocumentProcessor, CONTENT_HASH_ALGO, new_content_hasher
+from backend.simple_rag import SimpleRAGService, delete_file_index
+from backend.rag_service import RAGService, delete_file_embeddings
+from backend.llm_service import close_client as close_llm_client
+from backend.embedding_service import close_client as close_embedding_client
 from backend.config import settings
 
 # Create FastAPI app
-app = FastAPI(title="Document RAG Chatbot", version="1.0.0")
+app = FastAPI(title="Document RAG Chatbot", version="1.0.0", default_response_class=ORJSONResponse)
 
 # Add CORS middleware
 app.add_middleware(
@@ -27,12 +32,60 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Create upload directory
+# Create upload and index directories
 os.makedirs(settings.UPLOAD_DIR, exist_ok=True)
+os.makedirs(settings.INDEX_DIR, exist_ok=True)
+
+# Uploads are written to disk in pieces of this size
+UPLOAD_CHUNK_SIZE = 1 << 20  # 1MB
+
+def save_upload(source, file_path: str) -> Optional[str]:
+    """Stream an upload to disk in UPLOAD_CHUNK_SIZE pieces, hashing as it goes.
+    
+    Returns the content hash, or None (leaving nothing on disk) once the file exceeds MAX_FILE_SIZE.
+    """
+    size = 0
+    content_hasher = new_content_hasher()
+    with open(file_path, "wb") as buffer:
+        while chunk := source.read(UPLOAD_CHUNK_SIZE):
+            size += len(chunk)
+            if size > settings.MAX_FILE_SIZE:
+                break
+            content_hasher.update(chunk)
+            buffer.write(chunk)
+        else:
+            return content_hasher.hexdigest()
+    os.remove(file_path)
+    return None
+
+def backfill_content_hashes(db: Session):
+    """Rehash stored files whose content_hash predates hash_algo or came from another algorithm.
+    
+    A row whose file is gone, or whose bytes match a file already hashed, is left without a hash
+    but still marked with the current algorithm, so later startups don't look at it again.
+    """
+    stale = db.query(UploadedFile).filter(
+        or_(UploadedFile.hash_algo.is_(None), UploadedFile.hash_algo != CONTENT_HASH_ALGO)
+    ).all()
+    if not stale:
+        return
+    
+    taken = set(db.scalars(select(UploadedFile.content_hash).where(UploadedFile.hash_algo == CONTENT_HASH_ALGO)))
+    for db_file in stale:
+        content_hash = None
+        if os.path.exists(db_file.file_path):
+            content_hash = document_processor.calculate_file_hash(db_file.file_path)
+        if content_hash in taken:
+            content_hash = None
+        db_file.content_hash = content_hash
+        db_file.hash_algo = CONTENT_HASH_ALGO
+        if content_hash is not None:
+            taken.add(content_hash)
+    db.commit()
 
 # Initialize services
 document_processor = DocumentProcessor()
-rag_service = SimpleRAGService()
+rag_service = RAGService() if settings.RAG_BACKEND == "embeddings" else SimpleRAGService()
 
 # Pydantic models for API
 class ChatRequest(BaseModel):
@@ -65,6 +118,16 @@ class MessageInfo(BaseModel):
 @app.on_event("startup")
 async def startup_event():
     create_tables()
+    db = SessionLocal()
+    try:
+        await run_in_threadpool(backfill_content_hashes, db)
+    finally:
+        db.close()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await close_llm_client()
+    await close_embedding_client()
 
 # Serve frontend files
 app.mount("/static", StaticFiles(directory="frontend"), name="static")
@@ -93,27 +156,23 @@ async def upload_files(
                 errors.append(f"{file.filename}: Only Word documents (.docx, .doc) are supported")
                 continue
             
-            # Check file size
-            content = await file.read()
-            if len(content) > settings.MAX_FILE_SIZE:
-                errors.append(f"{file.filename}: File too large (max {settings.MAX_FILE_SIZE} bytes)")
-                continue
-            
             # Generate unique filename
             file_extension = os.path.splitext(file.filename)[1]
             unique_filename = f"{uuid.uuid4()}{file_extension}"
             file_path = os.path.join(settings.UPLOAD_DIR, unique_filename)
             
-            # Save file
-            with open(file_path, "wb") as buffer:
-                buffer.write(content)
+            # Copy and hash in one worker-thread call, so neither disk reads nor writes block the event loop
+            content_hash = await run_in_threadpool(save_upload, file.file, file_path)
+            
+            if content_hash is None:
+                errors.append(f"{file.filename}: File too large (max {settings.MAX_FILE_SIZE} bytes)")
+                continue
             
             # Process document
             try:
-                text, chunks, content_hash = document_processor.process_document(file_path)
-                
-                # Check for duplicate content
-                existing_file = db.query(UploadedFile).filter(
+                # Check for duplicate content before spending time on extraction (a probe of the unique hash index)
+                existing_file = db.query(UploadedFile.original_filename).filter(
+                    UploadedFile.hash_algo == CONTENT_HASH_ALGO,
                     UploadedFile.content_hash == content_hash
                 ).first()
                 
@@ -122,32 +181,43 @@ async def upload_files(
                     errors.append(f"{file.filename}: Duplicate content (already uploaded as {existing_file.original_filename})")
                     continue
                 
+                # Parsing and embedding are blocking, so keep them off the event loop
+                text, chunks, content_hash = await run_in_threadpool(
+                    document_processor.process_document, file_path, content_hash
+                )
+                
                 # Save to database
                 db_file = UploadedFile(
                     filename=unique_filename,
                     original_filename=file.filename,
                     file_path=file_path,
                     text_length=len(text),
-                    content_hash=content_hash
+                    content_hash=content_hash,
+                    hash_algo=CONTENT_HASH_ALGO
                 )
                 db.add(db_file)
-                db.commit()
-                db.refresh(db_file)
+                # Flush for the id only; the file row commits in the same transaction as its chunks
+                db.flush()
+                file_id = db_file.id
                 
                 # Generate and store embeddings
-                success = rag_service.store_document_embeddings(db, db_file.id, chunks)
+                success = await rag_service.astore_document_embeddings(db, file_id, chunks)
                 if not success:
+                    # The service rolled back, taking the pending file row with it
+                    os.remove(file_path)
                     errors.append(f"{file.filename}: Failed to generate embeddings")
                     continue
                 
                 uploaded_files.append({
-                    "id": db_file.id,
-                    "filename": db_file.original_filename,
-                    "text_length": db_file.text_length,
+                    "id": file_id,
+                    "filename": file.filename,
+                    "text_length": len(text),
                     "chunks_count": len(chunks)
                 })
                 
             except Exception as e:
+                # A failed flush leaves the transaction unusable for the files after this one
+                db.rollback()
                 os.remove(file_path)  # Clean up file on processing error
                 errors.append(f"{file.filename}: Processing error - {str(e)}")
                 continue
@@ -167,7 +237,14 @@ async def upload_files(
 @app.get("/api/files", response_model=List[FileInfo])
 async def list_files(db: Session = Depends(get_db)):
     """Get list of all uploaded files."""
-    files = db.query(UploadedFile).order_by(UploadedFile.upload_timestamp.desc()).all()
+    # Only the listed columns, so suggested titles and relationships are never loaded
+    files = db.query(
+        UploadedFile.id,
+        UploadedFile.filename,
+        UploadedFile.original_filename,
+        UploadedFile.upload_timestamp,
+        UploadedFile.text_length
+    ).order_by(UploadedFile.upload_timestamp.desc()).all()
     return [
         FileInfo(
             id=file.id,
@@ -216,14 +293,12 @@ async def chat(
     if not request.message.strip():
         raise HTTPException(status_code=400, detail="Message cannot be empty")
     
-    # Verify session exists
-    session = db.query(ChatSession).filter(ChatSession.session_id == request.session_id).first()
-    if not session:
+    # Generate response using RAG (the service looks up the session itself
+    # and keeps its blocking work off the event loop)
+    response = await rag_service.agenerate_answer(db, request.session_id, request.message)
+    if response is None:
         raise HTTPException(status_code=404, detail="Chat session not found")
     
-    # Generate response using RAG
-    response = rag_service.generate_answer(db, request.session_id, request.message)
-    
     return ChatResponse(
         response=response,
         session_id=request.session_id
@@ -233,12 +308,18 @@ async def chat(
 @app.get("/api/sessions", response_model=List[SessionInfo])
 async def get_chat_sessions(db: Session = Depends(get_db)):
     """Get all chat sessions."""
-    sessions = db.query(ChatSession).join(UploadedFile).order_by(ChatSession.updated_at.desc()).all()
+    # Filename comes from the join, not a lazy load of session.file per row
+    sessions = db.query(
+        ChatSession.session_id,
+        ChatSession.file_id,
+        UploadedFile.original_filename,
+        ChatSession.created_at
+    ).join(UploadedFile).order_by(ChatSession.updated_at.desc()).all()
     return [
         SessionInfo(
             session_id=session.session_id,
             file_id=session.file_id,
-            filename=session.file.original_filename,
+            filename=session.original_filename,
             created_at=session.created_at.isoformat()
         )
         for session in sessions
@@ -289,6 +370,8 @@ async def delete_file(
     # Delete from database (cascades to chunks and sessions)
     db.delete(file)
     db.commit()
+    delete_file_embeddings(file_id)
+    delete_file_index(file_id)
     
     return {"message": "File deleted successfully"}
 
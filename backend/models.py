@@ -1,10 +1,14 @@
-from sqlalchemy import Column, Integer, String, DateTime, Text, ForeignKey, Float
+from sqlalchemy import Column, Integer, String, DateTime, Text, ForeignKey, Float, LargeBinary, Index
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from backend.database import Base
 
 class UploadedFile(Base):
     __tablename__ = "uploaded_files"
+    __table_args__ = (
+        # A hash only identifies content together with the algorithm that produced it
+        Index("ix_file_algo_hash", "hash_algo", "content_hash", unique=True),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     filename = Column(String, nullable=False)
@@ -12,7 +16,9 @@ class UploadedFile(Base):
     file_path = Column(String, nullable=False)
     upload_timestamp = Column(DateTime(timezone=True), server_default=func.now())
     text_length = Column(Integer, nullable=False, default=0)
-    content_hash = Column(String, nullable=True)  # For deduplication
+    content_hash = Column(String, nullable=True)  # Hash of the raw file bytes, for deduplication
+    hash_algo = Column(String, nullable=True)  # Algorithm behind content_hash; NULL on rows from before it was recorded
+    suggested_titles = Column(Text, nullable=True)  # Title-suggestion reply, computed once at ingest
     
     # Relationships
     chunks = relationship("DocumentChunk", back_populates="file", cascade="all, delete-orphan")
@@ -20,6 +26,10 @@ class UploadedFile(Base):
 
 class DocumentChunk(Base):
     __tablename__ = "document_chunks"
+    __table_args__ = (
+        # Serves per-file chunk loads in document order without a sort
+        Index("ix_chunk_file_idx", "file_id", "chunk_index"),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     file_id = Column(Integer, ForeignKey("uploaded_files.id"), nullable=False)
@@ -27,7 +37,7 @@ class DocumentChunk(Base):
     chunk_index = Column(Integer, nullable=False)
     start_char = Column(Integer, nullable=False, default=0)
     end_char = Column(Integer, nullable=False, default=0)
-    embedding_vector = Column(Text, nullable=True)  # JSON string of embedding
+    embedding_vector = Column(LargeBinary, nullable=True)  # Raw float32 bytes of embedding
     
     # Relationships
     file = relationship("UploadedFile", back_populates="chunks")
@@ -40,6 +50,9 @@ class ChatSession(Base):
     file_id = Column(Integer, ForeignKey("uploaded_files.id"), nullable=False)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+    # Running mean of the session's query embeddings (float32 bytes), updated once per turn
+    history_vector = Column(LargeBinary, nullable=True)
+    history_count = Column(Integer, nullable=False, default=0, server_default="0")
     
     # Relationships
     file = relationship("UploadedFile", back_populates="chat_sessions")
@@ -47,13 +60,32 @@ class ChatSession(Base):
 
 class ChatMessage(Base):
     __tablename__ = "chat_messages"
+    __table_args__ = (
+        # Serves history lookups: filter by session, ordered by time
+        Index("ix_msg_sess_ts", "session_id", "timestamp"),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     session_id = Column(String, ForeignKey("chat_sessions.session_id"), nullable=False)
     message_type = Column(String, nullable=False)  # 'user' or 'assistant'
     content = Column(Text, nullable=False)
     timestamp = Column(DateTime(timezone=True), server_default=func.now())
-    context_chunks = Column(Text, nullable=True)  # JSON string of relevant chunks
+    context_chunks = Column(Text, nullable=True)  # Legacy JSON string of relevant chunks; see MessageContext
     
     # Relationships
-    session = relationship("ChatSession", back_populates="messages")
\ No newline at end of file
+    session = relationship("ChatSession", back_populates="messages")
+    context = relationship("MessageContext", back_populates="message", cascade="all, delete-orphan",
+                           order_by="MessageContext.rank")
+
+class MessageContext(Base):
+    __tablename__ = "message_contexts"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    message_id = Column(Integer, ForeignKey("chat_messages.id"), nullable=False, index=True)
+    chunk_id = Column(Integer, ForeignKey("document_chunks.id"), nullable=False)
+    rank = Column(Integer, nullable=False)  # 0 for the most relevant chunk
+    similarity = Column(Float, nullable=False)
+    
+    # Relationships
+    message = relationship("ChatMessage", back_populates="context")
+    chunk = relationship("DocumentChunk")
\ No newline at end of file
@@ -0,0 +1,69 @@
+"""
+Local embedding inference with ONNX Runtime, used instead of the API when a model directory is configured
+"""
+import os
+from typing import List, Optional
+import numpy as np
+
+try:
+    import onnxruntime as ort
+    from tokenizers import Tokenizer
+except ImportError:  # ONNX Runtime is optional; embeddings come from the Hugging Face API
+    ort = None
+    Tokenizer = None
+
+# A dynamically quantized INT8 export is preferred when the directory has both
+MODEL_FILES = ("model_quantized.onnx", "model.onnx")
+MAX_SEQ_LENGTH = 256
+
+class OnnxEmbedder:
+    """Mean-pooled sentence embeddings from an exported transformer."""
+    
+    def __init__(self, session, tokenizer):
+        self.session = session
+        self.tokenizer = tokenizer
+        self.input_names = {model_input.name for model_input in session.get_inputs()}
+    
+    def embed(self, texts: List[str]) -> np.ndarray:
+        """Embed a batch of texts as one float32 matrix, one row per text."""
+        # The tokenizer pads to the longest text in the batch
+        encodings = self.tokenizer.encode_batch(texts)
+        input_ids = np.array([encoding.ids for encoding in encodings], dtype=np.int64)
+        attention_mask = np.array([encoding.attention_mask for encoding in encodings], dtype=np.int64)
+        
+        feeds = {"input_ids": input_ids, "attention_mask": attention_mask}
+        if "token_type_ids" in self.input_names:
+            feeds["token_type_ids"] = np.zeros_like(input_ids)
+        token_embeddings = self.session.run(None, feeds)[0]
+        
+        # Average over real tokens only, so padding doesn't dilute short texts
+        mask = attention_mask[:, :, None].astype(np.float32)
+        summed = (token_embeddings * mask).sum(axis=1)
+        return (summed / np.maximum(mask.sum(axis=1), 1e-9)).astype(np.float32)
+
+def load_embedder(model_dir: str) -> Optional[OnnxEmbedder]:
+    """Open the ONNX model and tokenizer in model_dir, or None if unavailable."""
+    if ort is None or not model_dir:
+        return None
+    
+    model_path = next(
+        (os.path.join(model_dir, name) for name in MODEL_FILES if os.path.exists(os.path.join(model_dir, name))),
+        None
+    )
+    tokenizer_path = os.path.join(model_dir, "tokenizer.json")
+    if model_path is None or not os.path.exists(tokenizer_path):
+        print(f"No ONNX embedding model found in {model_dir}; using the embedding API")
+        return None
+    
+    try:
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        session = ort.InferenceSession(model_path, options, providers=["CPUExecutionProvider"])
+        
+        tokenizer = Tokenizer.from_file(tokenizer_path)
+        tokenizer.enable_padding()
+        tokenizer.enable_truncation(MAX_SEQ_LENGTH)
+        return OnnxEmbedder(session, tokenizer)
+    except Exception as e:
+        print(f"Error loading ONNX embedding model: {str(e)}")
+        return None
\ No newline at end of file
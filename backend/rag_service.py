@@ -1,16 +1,97 @@
-from typing import List, Optional, Tuple
+import os
+import asyncio
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import insert, update
 from sqlalchemy.orm import Session
-from backend.models import UploadedFile, DocumentChunk, ChatSession, ChatMessage
-from backend.embedding_service import EmbeddingService
+from backend.models import UploadedFile, DocumentChunk, ChatSession, ChatMessage, MessageContext
+from backend.embedding_service import EmbeddingService, BatchingEmbedder
+from backend.ann_index import build_index, load_index, search_index, remove_index
 from backend.llm_service import LLMService
 from backend.config import settings
-import json
+import threading
+from collections import OrderedDict
+
+# Per-file (chunk_matrix, row_scales, chunk_ids, ann_index) kept in least-recently-used order
+MATRIX_CACHE_SIZE = 32
+_matrix_cache: "OrderedDict[int, tuple]" = OrderedDict()
+_matrix_cache_lock = threading.Lock()
+# Bumped on every invalidation so a load that raced with a re-ingest is not cached; one counter
+# for all files keeps nothing per deleted file, at the cost of skipping a cache fill on any race
+_cache_generation = 0
+
+def invalidate_file_cache(file_id: int):
+    """Drop the cached chunk matrix for a file."""
+    global _cache_generation
+    with _matrix_cache_lock:
+        _matrix_cache.pop(file_id, None)
+        _cache_generation += 1
+
+def fetch_chunk_texts(db: Session, chunk_ids: List[int]) -> Dict[int, str]:
+    """Texts for the given chunk ids, keyed by id."""
+    if not chunk_ids:
+        return {}
+    return dict(db.query(DocumentChunk.id, DocumentChunk.chunk_text).filter(
+        DocumentChunk.id.in_([int(chunk_id) for chunk_id in chunk_ids])
+    ).all())
+
+def store_conversation_turn(db: Session, session_id: str, query: str, response: str,
+                            relevant_chunks: List[Tuple[int, str, float]], session_updates: Optional[dict] = None):
+    """Store user query and assistant response, with the assistant's context, in one transaction.
+    
+    session_updates are column values written to the chat session in the same transaction.
+    On failure the transaction is rolled back and the error re-raised, so no caller answers
+    with a turn that was never saved.
+    """
+    try:
+        # Both messages in one multi-row INSERT; ids come back in parameter order
+        _, assistant_id = db.scalars(
+            insert(ChatMessage).returning(ChatMessage.id, sort_by_parameter_order=True),
+            [
+                {"session_id": session_id, "message_type": "user", "content": query},
+                {"session_id": session_id, "message_type": "assistant", "content": response}
+            ]
+        ).all()
+        
+        # Link the assistant response to the chunks it was built from (top 3)
+        context_rows = [
+            {"message_id": assistant_id, "chunk_id": chunk_id, "rank": rank, "similarity": float(similarity)}
+            for rank, (chunk_id, _, similarity) in enumerate(relevant_chunks[:3])
+        ]
+        if context_rows:
+            db.execute(insert(MessageContext), context_rows)
+        
+        if session_updates:
+            db.execute(update(ChatSession).where(ChatSession.session_id == session_id).values(**session_updates))
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+
+def embedding_matrix_path(file_id: int) -> str:
+    """Location of a file's stacked embedding matrix (one row per stored chunk)."""
+    return os.path.join(settings.INDEX_DIR, f"{file_id}.emb.npy")
+
+def embedding_scales_path(file_id: int) -> str:
+    """Location of the per-row int8 scales for a file's embedding matrix."""
+    return os.path.join(settings.INDEX_DIR, f"{file_id}.scale.npy")
+
+def delete_file_embeddings(file_id: int):
+    """Remove a file's embedding matrix and index from disk and from the cache."""
+    invalidate_file_cache(file_id)
+    for path in (embedding_matrix_path(file_id), embedding_scales_path(file_id)):
+        if os.path.exists(path):
+            os.remove(path)
+    remove_index(file_id)
 
 class RAGService:
     def __init__(self):
         self.embedding_service = EmbeddingService()
+        self.embedding_batcher = BatchingEmbedder(self.embedding_service)
         self.llm_service = LLMService()
         self.max_chunks_for_context = settings.MAX_CHUNKS_FOR_CONTEXT
+        self.history_weight = settings.HISTORY_WEIGHT
     
     def store_document_embeddings(self, db: Session, file_id: int, chunks: List[Tuple[str, int, int]]) -> bool:
         """Generate and store embeddings for document chunks."""
@@ -18,28 +99,70 @@ class RAGService:
             # Get embeddings for all chunks
             chunk_texts = [chunk[0] for chunk in chunks]
             embeddings = self.embedding_service.get_embeddings_batch(chunk_texts)
-            
-            # Store chunks with embeddings
+        except Exception as e:
+            print(f"Error storing document embeddings: {str(e)}")
+            # The caller's file row is pending in this transaction and must not outlive the failure
+            db.rollback()
+            return False
+        return self._save_document_embeddings(db, file_id, chunks, embeddings)
+    
+    async def astore_document_embeddings(self, db: Session, file_id: int, chunks: List[Tuple[str, int, int]]) -> bool:
+        """Like store_document_embeddings, but the embedding requests overlap on the event loop."""
+        try:
+            chunk_texts = [chunk[0] for chunk in chunks]
+            embeddings = await self.embedding_service.aget_embeddings_batch(chunk_texts)
+        except Exception as e:
+            print(f"Error storing document embeddings: {str(e)}")
+            # The caller's file row is pending in this transaction and must not outlive the failure
+            db.rollback()
+            return False
+        # Index building and the insert are blocking work
+        return await run_in_threadpool(self._save_document_embeddings, db, file_id, chunks, embeddings)
+    
+    def _save_document_embeddings(self, db: Session, file_id: int, chunks: List[Tuple[str, int, int]],
+                                  embeddings: List[Optional[np.ndarray]]) -> bool:
+        """Write chunk rows and the file's embedding matrix and index."""
+        try:
+            # Build chunk rows and the matching embedding matrix
+            rows = []
+            vectors = []
             for i, ((chunk_text, start_char, end_char), embedding) in enumerate(zip(chunks, embeddings)):
                 if embedding is None:
                     print(f"Warning: Failed to get embedding for chunk {i}")
                     continue
                 
-                chunk_record = DocumentChunk(
-                    file_id=file_id,
-                    chunk_text=chunk_text,
-                    chunk_index=i,
-                    start_char=start_char,
-                    end_char=end_char,
-                    embedding_vector=self.embedding_service.embedding_to_string(embedding)
-                )
-                db.add(chunk_record)
+                rows.append({
+                    "file_id": file_id,
+                    "chunk_text": chunk_text,
+                    "chunk_index": i,
+                    "start_char": start_char,
+                    "end_char": end_char
+                })
+                vectors.append(embedding)
             
+            # A file with nothing embedded could never be retrieved, so it isn't kept
+            if not vectors:
+                print(f"Error storing document embeddings: no chunk of file {file_id} was embedded")
+                db.rollback()
+                return False
+            
+            # Embeddings live in one .npy per file; rows keep text and offsets only
+            matrix = self.embedding_service.normalize_embeddings(np.stack(vectors))
+            quantized, scales = self.embedding_service.quantize_embeddings(matrix)
+            np.save(embedding_matrix_path(file_id), quantized)
+            np.save(embedding_scales_path(file_id), scales)
+            # Very large files also get a compressed ANN index so queries skip the full scan
+            build_index(file_id, matrix)
+            
+            # Insert all chunks in a single executemany statement; the Core table skips ORM bulk-insert bookkeeping
+            db.execute(insert(DocumentChunk.__table__), rows)
             db.commit()
+            invalidate_file_cache(file_id)
             return True
         except Exception as e:
             print(f"Error storing document embeddings: {str(e)}")
             db.rollback()
+            delete_file_embeddings(file_id)
             return False
     
     def retrieve_relevant_chunks(self, db: Session, file_id: int, query: str) -> List[Tuple[str, float]]:
@@ -47,41 +170,42 @@ class RAGService:
         try:
             # Get query embedding
             query_embedding = self.embedding_service.get_embedding(query)
-            if not query_embedding:
-                return []
-            
-            # Get all chunks for the file
-            chunks = db.query(DocumentChunk).filter(DocumentChunk.file_id == file_id).all()
-            if not chunks:
+            return [(text, similarity) for _, text, similarity in self._retrieve_for_embedding(db, file_id, query_embedding)]
+        
+        except Exception as e:
+            print(f"Error retrieving relevant chunks: {str(e)}")
+            return []
+    
+    def _retrieve_for_embedding(self, db: Session, file_id: int,
+                                query_embedding: Optional[np.ndarray]) -> List[Tuple[int, str, float]]:
+        """Retrieve (chunk id, text, similarity) for an already-computed query embedding."""
+        try:
+            if query_embedding is None:
                 return []
             
-            # Extract embeddings and texts
-            chunk_embeddings = []
-            chunk_texts = []
-            
-            for chunk in chunks:
-                if chunk.embedding_vector:
-                    try:
-                        embedding = self.embedding_service.string_to_embedding(chunk.embedding_vector)
-                        chunk_embeddings.append(embedding)
-                        chunk_texts.append(chunk.chunk_text)
-                    except Exception as e:
-                        print(f"Error parsing embedding for chunk {chunk.id}: {str(e)}")
-                        continue
-            
-            if not chunk_embeddings:
+            # Get the file's chunk matrix, loading it on first use
+            chunk_matrix, row_scales, chunk_ids, ann_index = self._load_matrix(db, file_id)
+            if chunk_matrix is None:
                 return []
             
-            # Find similar chunks
-            similar_chunks = self.embedding_service.find_similar_chunks(
-                query_embedding, chunk_embeddings, self.max_chunks_for_context
-            )
+            # Find similar chunks (embeddings are normalized at storage time)
+            if ann_index is not None:
+                similar_chunks = search_index(
+                    ann_index, self.embedding_service.normalize_embedding(query_embedding),
+                    self.max_chunks_for_context
+                )
+            else:
+                similar_chunks = self.embedding_service.find_similar_chunks(
+                    query_embedding, chunk_matrix, self.max_chunks_for_context, row_scales
+                )
             
-            # Return relevant chunks with similarity scores
+            # Fetch text only for the top chunks and return them with similarity scores
+            top_ids = [int(chunk_ids[chunk_idx]) for chunk_idx, _ in similar_chunks if chunk_idx < len(chunk_ids)]
+            texts = fetch_chunk_texts(db, top_ids)
             relevant_chunks = []
-            for chunk_idx, similarity in similar_chunks:
-                if chunk_idx < len(chunk_texts):
-                    relevant_chunks.append((chunk_texts[chunk_idx], similarity))
+            for chunk_id, (_, similarity) in zip(top_ids, similar_chunks):
+                if chunk_id in texts:
+                    relevant_chunks.append((chunk_id, texts[chunk_id], similarity))
             
             return relevant_chunks
         
@@ -89,34 +213,102 @@ class RAGService:
             print(f"Error retrieving relevant chunks: {str(e)}")
             return []
     
-    def generate_answer(self, db: Session, session_id: str, query: str) -> str:
-        """Generate answer using RAG pipeline."""
+    def _load_matrix(self, db: Session, file_id: int) -> Tuple[Optional[np.ndarray], Optional[np.ndarray], np.ndarray, Optional[object]]:
+        """Get the embedding matrix, its int8 row scales, chunk ids and ANN index for a file, using the cache."""
+        with _matrix_cache_lock:
+            cached = _matrix_cache.get(file_id)
+            if cached is not None:
+                _matrix_cache.move_to_end(file_id)
+                return cached
+            generation = _cache_generation
+        
+        matrix_path = embedding_matrix_path(file_id)
+        if os.path.exists(matrix_path):
+            # Memory-mapped: no parsing, and pages are shared through the OS cache
+            chunk_matrix = np.load(matrix_path, mmap_mode='r')
+            # Streamed in batches straight into the id array, never a full list of rows
+            chunk_ids = np.fromiter((row.id for row in db.query(DocumentChunk.id).filter(
+                DocumentChunk.file_id == file_id
+            ).order_by(DocumentChunk.chunk_index).yield_per(1024)), dtype=np.int64)
+            if len(chunk_ids) != chunk_matrix.shape[0]:
+                print(f"Warning: Embedding matrix for file {file_id} does not match its chunks")
+                return None, None, np.empty(0, dtype=np.int64), None
+            # Matrices written before per-row scales use the fixed int8 step
+            scales_path = embedding_scales_path(file_id)
+            row_scales = np.load(scales_path) if os.path.exists(scales_path) else None
+            ann_index = load_index(file_id)
+        else:
+            chunk_matrix, chunk_ids = self._load_matrix_from_rows(db, file_id)
+            if chunk_matrix is None:
+                return None, None, np.empty(0, dtype=np.int64), None
+            row_scales = None
+            ann_index = None
+        
+        entry = (chunk_matrix, row_scales, chunk_ids, ann_index)
+        with _matrix_cache_lock:
+            if _cache_generation == generation:
+                _matrix_cache[file_id] = entry
+                while len(_matrix_cache) > MATRIX_CACHE_SIZE:
+                    _matrix_cache.popitem(last=False)
+        return entry
+    
+    def _load_matrix_from_rows(self, db: Session, file_id: int) -> Tuple[Optional[np.ndarray], np.ndarray]:
+        """Build the chunk matrix from per-row embeddings (files stored before per-file matrices)."""
+        # Stream ids and embedding bytes only; chunk text is fetched later for the top hits
+        blobs = []
+        chunk_ids = []
+        for chunk_id, embedding_vector in db.query(DocumentChunk.id, DocumentChunk.embedding_vector).filter(
+            DocumentChunk.file_id == file_id
+        ).order_by(DocumentChunk.chunk_index).yield_per(1024):
+            if embedding_vector:
+                if isinstance(embedding_vector, str):
+                    # JSON text from before embeddings were stored as bytes
+                    embedding_vector = self.embedding_service.embedding_to_bytes(
+                        self.embedding_service.bytes_to_embedding(embedding_vector)
+                    )
+                blobs.append(embedding_vector)
+                chunk_ids.append(chunk_id)
+        
+        if not blobs:
+            return None, np.empty(0, dtype=np.int64)
+        
+        if any(len(blob) != len(blobs[0]) for blob in blobs):
+            print(f"Error parsing embeddings for file {file_id}: inconsistent embedding sizes")
+            return None, np.empty(0, dtype=np.int64)
+        
+        # Decode every row with a single frombuffer over the concatenated bytes
+        chunk_matrix = np.frombuffer(b"".join(blobs), dtype=np.float32).reshape(len(blobs), -1)
+        
+        # Older rows may predate normalization at store time
+        return self.embedding_service.normalize_embeddings(chunk_matrix), np.array(chunk_ids, dtype=np.int64)
+    
+    async def agenerate_answer(self, db: Session, session_id: str, query: str) -> Optional[str]:
+        """Generate answer using RAG pipeline. Returns None if the session does not exist."""
         try:
-            # Get chat session and file
-            session = db.query(ChatSession).filter(ChatSession.session_id == session_id).first()
-            if not session:
-                return "Session not found. Please start a new conversation."
-            
-            # Retrieve relevant chunks
-            relevant_chunks = self.retrieve_relevant_chunks(db, session.file_id, query)
+            # The query embedding and the session lookup don't depend on each other, so overlap them
+            query_embedding, rows = await asyncio.gather(
+                self.embedding_batcher.embed(query),
+                run_in_threadpool(self._load_session_history, db, session_id)
+            )
+            if not rows:
+                return None
+            file_id = rows[0].file_id
             
-            # Get conversation history
-            conversation_history = db.query(ChatMessage).filter(
-                ChatMessage.session_id == session_id
-            ).order_by(ChatMessage.timestamp.desc()).limit(10).all()
+            # Retrieve relevant chunks, steered by what the session has asked about so far
+            retrieval_embedding = self._with_history(query_embedding, rows[0].history_vector, rows[0].history_count)
+            relevant_chunks = await run_in_threadpool(self._retrieve_for_embedding, db, file_id, retrieval_embedding)
             
-            # Reverse to get chronological order
-            conversation_history = list(reversed(conversation_history))
+            # Reverse to get chronological order (a session without messages yields one empty row)
             history_dicts = [
-                {"message_type": msg.message_type, "content": msg.content}
-                for msg in conversation_history
+                {"message_type": row.message_type, "content": row.content}
+                for row in reversed(rows) if row.message_type is not None
             ]
             
             # Extract chunk texts for context
-            context_chunks = [chunk[0] for chunk in relevant_chunks]
+            context_chunks = [chunk[1] for chunk in relevant_chunks]
             
             # Generate response
-            response = self.llm_service.generate_response(
+            response = await self.llm_service.generate_response(
                 query, context_chunks, history_dicts
             )
             
@@ -124,7 +316,15 @@ class RAGService:
                 response = self._fallback_response(context_chunks)
             
             # Store the conversation
-            self._store_conversation_turn(db, session_id, query, response, relevant_chunks)
+            history_vector, history_count = self._roll_history_vector(
+                rows[0].history_vector, rows[0].history_count, query_embedding
+            )
+            session_updates = None
+            if history_vector is not None:
+                session_updates = {"history_vector": history_vector, "history_count": history_count}
+            await run_in_threadpool(
+                store_conversation_turn, db, session_id, query, response, relevant_chunks, session_updates
+            )
             
             return response
         
@@ -132,37 +332,45 @@ class RAGService:
             print(f"Error generating answer: {str(e)}")
             return "I encountered an error while processing your question. Please try again."
     
-    def _store_conversation_turn(self, db: Session, session_id: str, query: str, 
-                                response: str, relevant_chunks: List[Tuple[str, float]]):
-        """Store user query and assistant response."""
-        try:
-            # Store user message
-            user_message = ChatMessage(
-                session_id=session_id,
-                message_type="user",
-                content=query
-            )
-            db.add(user_message)
-            
-            # Store assistant response with context
-            context_info = json.dumps([
-                {"text": chunk[0][:200] + "..." if len(chunk[0]) > 200 else chunk[0], 
-                 "similarity": chunk[1]}
-                for chunk in relevant_chunks[:3]  # Store top 3 chunks info
-            ])
-            
-            assistant_message = ChatMessage(
-                session_id=session_id,
-                message_type="assistant",
-                content=response,
-                context_chunks=context_info
-            )
-            db.add(assistant_message)
-            
-            db.commit()
-        except Exception as e:
-            print(f"Error storing conversation: {str(e)}")
-            db.rollback()
+    def _load_session_history(self, db: Session, session_id: str) -> list:
+        """Get the session's file and recent conversation history in one query, newest first."""
+        return db.query(
+            ChatSession.file_id, ChatSession.history_vector, ChatSession.history_count,
+            ChatMessage.message_type, ChatMessage.content
+        ).outerjoin(
+            ChatMessage, ChatMessage.session_id == ChatSession.session_id
+        ).filter(
+            ChatSession.session_id == session_id
+        ).order_by(ChatMessage.timestamp.desc(), ChatMessage.id.desc()).limit(10).all()
+    
+    def _with_history(self, query_embedding: Optional[np.ndarray], history_vector: Optional[bytes],
+                      history_count: int) -> Optional[np.ndarray]:
+        """Blend the query with the session's running mean of earlier queries, for retrieval.
+        
+        A follow-up like "tell me more" says little by itself; the earlier queries say what it is about.
+        """
+        if query_embedding is None or not history_vector or history_count <= 0 or self.history_weight <= 0:
+            return query_embedding
+        
+        previous = self.embedding_service.bytes_to_embedding(history_vector)
+        if previous.shape != query_embedding.shape:
+            return query_embedding
+        normalize = self.embedding_service.normalize_embedding
+        return normalize(query_embedding) + self.history_weight * normalize(previous)
+    
+    def _roll_history_vector(self, history_vector: Optional[bytes], history_count: int,
+                             query_embedding: Optional[np.ndarray]) -> Tuple[Optional[bytes], int]:
+        """Fold this turn's query embedding into the session's running mean. Returns (bytes, count)."""
+        if query_embedding is None:
+            return None, history_count
+        
+        previous = self.embedding_service.bytes_to_embedding(history_vector) if history_vector else None
+        # Start over when there is no history yet or the embedding model changed
+        if previous is None or history_count <= 0 or previous.shape != query_embedding.shape:
+            return self.embedding_service.embedding_to_bytes(query_embedding), 1
+        return self.embedding_service.embedding_to_bytes(
+            (previous * history_count + query_embedding) / (history_count + 1)
+        ), history_count + 1
     
     def _fallback_response(self, context_chunks: List[str]) -> str:
         """Provide fallback response when LLM fails."""
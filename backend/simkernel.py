@@ -0,0 +1,70 @@
+"""
+Similarity kernels for large chunk matrices, JIT-compiled with Numba when it is installed
+"""
+import os
+import numpy as np
+from backend.config import settings
+
+# Both are read when Numba is imported. cache=True would otherwise write compiled kernels into
+# backend/__pycache__, which a read-only deploy can't do; INDEX_DIR has to be writable anyway.
+os.environ.setdefault("NUMBA_CACHE_DIR", os.path.join(settings.INDEX_DIR, "numba"))
+# Kernels run on the request thread pool, and a TBB pool first started off the main thread
+# hangs the process at exit, so take OpenMP when it is available
+os.environ.setdefault("NUMBA_THREADING_LAYER_PRIORITY", "omp tbb workqueue")
+
+try:
+    from numba import njit, prange
+except ImportError:  # Numba is optional; fall back to NumPy's matrix product
+    njit = None
+
+# Above this many rows the parallel kernel outruns BLAS dispatch for small embedding sizes
+PARALLEL_THRESHOLD = 2048
+
+if njit is not None:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _dot_rows(matrix, query, out):
+        n, d = matrix.shape
+        for i in prange(n):
+            total = np.float32(0.0)
+            for j in range(d):
+                total += matrix[i, j] * query[j]
+            out[i] = total
+
+    @njit(parallel=True, cache=True)
+    def _dot_rows_int8(matrix, query, out):
+        n, d = matrix.shape
+        for i in prange(n):
+            total = np.int32(0)
+            for j in range(d):
+                total += np.int32(matrix[i, j]) * np.int32(query[j])
+            out[i] = total
+else:
+    _dot_rows = None
+    _dot_rows_int8 = None
+
+def dot_similarities(matrix: np.ndarray, query: np.ndarray) -> np.ndarray:
+    """Dot product of every row of a float32 or int8 matrix with a query vector.
+
+    For float32, L2-normalized inputs give the cosine similarity of each row. For int8 the
+    query must be quantized too and the result is the raw integer dot product of each row;
+    the caller applies the row and query scales.
+    """
+    if matrix.dtype == np.int8:
+        return _dot_int8(matrix, query)
+    if _dot_rows is not None and matrix.shape[0] > PARALLEL_THRESHOLD:
+        # Allocated per call: requests run in a thread pool, so a shared buffer would race
+        out = np.empty(matrix.shape[0], dtype=np.float32)
+        _dot_rows(matrix, query, out)
+        return out
+    return matrix @ query
+
+def _dot_int8(matrix: np.ndarray, query: np.ndarray) -> np.ndarray:
+    """Raw integer dot products of an int8 matrix with a quantized query."""
+    if _dot_rows_int8 is not None:
+        # int32 accumulation straight off the int8 rows, no upcast copy of the matrix
+        out = np.empty(matrix.shape[0], dtype=np.int32)
+        _dot_rows_int8(matrix, query, out)
+        return out
+    # |products| sum to at most 127 * 127 * dim, well inside float32's exact integer range,
+    # so the BLAS float path gives exactly the int32 result
+    return matrix.astype(np.float32) @ query.astype(np.float32)
\ No newline at end of file
@@ -1,11 +1,166 @@
 """
 Simple RAG implementation that works without complex API calls
 """
+import os
 import re
-from typing import List, Tuple
-from sqlalchemy.orm import Session
-from backend.models import UploadedFile, DocumentChunk, ChatSession, ChatMessage
 import json
+import threading
+from collections import OrderedDict
+from typing import Dict, FrozenSet, List, Optional, Tuple
+import numpy as np
+import scipy.sparse
+from fastapi.concurrency import run_in_threadpool
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sqlalchemy import insert, update
+from sqlalchemy.orm import Session
+from backend.models import UploadedFile, DocumentChunk, ChatSession
+from backend.embedding_service import top_k_indices
+from backend.rag_service import fetch_chunk_texts, store_conversation_turn
+from backend.config import settings
+
+# Common words that carry no meaning for matching
+STOP_WORDS = frozenset({'the', 'a', 'an', 'and', 'or', 'but', 'in', 'on', 'at', 'to', 'for', 'of', 'with', 'by', 'is', 'are', 'was', 'were', 'be', 'been', 'have', 'has', 'had', 'do', 'does', 'did', 'will', 'would', 'could', 'should', 'may', 'might', 'can', 'what', 'where', 'when', 'why', 'how', 'there', 'here', 'this', 'that', 'these', 'those'})
+
+# Sentence boundaries used when truncating long chunks
+_SENT_RE = re.compile(r'[.!?]+')
+
+# Phrases that mark what kind of answer a query wants
+_INTENT_PHRASES = {
+    'beginning': ('first page', '1st page', 'page 1', 'beginning', 'start'),
+    'title': ('title', 'suggest title', 'name for', 'call this document'),
+    'summary': ('summary', 'summarize', 'overview', 'main points')
+}
+
+def query_intents(query: str) -> FrozenSet[str]:
+    """Every intent whose phrases appear in the query."""
+    query_lower = query.lower()
+    return frozenset(
+        intent for intent, phrases in _INTENT_PHRASES.items()
+        if any(phrase in query_lower for phrase in phrases)
+    )
+
+# Opening line of a simple response, by kind of query
+_RESPONSE_HEADERS = {
+    'beginning': "Here's what I found from the beginning of the document:",
+    'summary': "Here's a summary based on the document content:",
+    'question': "Based on your question, here's what I found in the document:",
+    'default': "Here's the relevant information from the document:"
+}
+
+# Technical document indicators
+_TECH_TERMS = {
+    'api': 'API', 'database': 'Database', 'security': 'Security', 
+    'encryption': 'Security', 'dashboard': 'Dashboard', 'system': 'System',
+    'application': 'Application', 'software': 'Software', 'platform': 'Platform',
+    'architecture': 'Architecture', 'framework': 'Framework', 'service': 'Service',
+    'development': 'Development', 'implementation': 'Implementation',
+    'management': 'Management', 'analysis': 'Analysis', 'report': 'Report',
+    'documentation': 'Documentation', 'guide': 'Guide', 'manual': 'Manual',
+    'specification': 'Specification', 'requirements': 'Requirements',
+    'design': 'Design', 'configuration': 'Configuration', 'deployment': 'Deployment'
+}
+
+# Business document indicators
+_BUSINESS_TERMS = {
+    'business': 'Business', 'strategy': 'Strategy', 'plan': 'Plan',
+    'proposal': 'Proposal', 'contract': 'Contract', 'agreement': 'Agreement',
+    'policy': 'Policy', 'procedure': 'Procedure', 'process': 'Process',
+    'workflow': 'Workflow', 'project': 'Project', 'timeline': 'Timeline',
+    'budget': 'Budget', 'financial': 'Financial', 'revenue': 'Revenue',
+    'marketing': 'Marketing', 'sales': 'Sales', 'customer': 'Customer'
+}
+
+# Academic/Research document indicators
+_ACADEMIC_TERMS = {
+    'research': 'Research', 'study': 'Study', 'analysis': 'Analysis',
+    'thesis': 'Thesis', 'dissertation': 'Dissertation', 'paper': 'Paper',
+    'journal': 'Journal', 'article': 'Article', 'review': 'Review',
+    'survey': 'Survey', 'experiment': 'Experiment', 'methodology': 'Methodology'
+}
+
+# Topic keyword -> display name used when suggesting titles, merged once at import
+_TITLE_TERMS = {**_TECH_TERMS, **_BUSINESS_TERMS, **_ACADEMIC_TERMS}
+
+# Per-file (chunk_ids, vectorizer, tfidf_matrix) kept in least-recently-used order;
+# the matrix is stored column-major so it doubles as an inverted index
+INDEX_CACHE_SIZE = 32
+_index_cache: "OrderedDict[int, tuple]" = OrderedDict()
+_index_cache_lock = threading.Lock()
+# Bumped on every invalidation so a load that raced with a re-ingest is not cached; one counter
+# for all files keeps nothing per deleted file, at the cost of skipping a cache fill on any race
+_index_generation = 0
+# Retrieval results per (file_id, lowercased query), each tagged with the index entry it was
+# ranked against; an entry whose index is no longer cached is stale and ignored
+RESULT_CACHE_SIZE = 1024
+_result_cache: "OrderedDict[tuple, tuple]" = OrderedDict()
+# Each file's first (id, chunk_text) row, so the fallback paths don't go back to the database
+FIRST_CHUNK_CACHE_SIZE = 1024
+_first_chunk_cache: "OrderedDict[int, tuple]" = OrderedDict()
+
+def invalidate_file_index(file_id: int):
+    """Drop the cached TF-IDF index for a file."""
+    global _index_generation
+    with _index_cache_lock:
+        _index_cache.pop(file_id, None)
+        _first_chunk_cache.pop(file_id, None)
+        _index_generation += 1
+
+def title_chunk_positions(num_chunks: int) -> List[int]:
+    """Chunk positions spread across the document, used for title analysis."""
+    if num_chunks <= 0:
+        return []
+    return [0, num_chunks//3, num_chunks//2, num_chunks*2//3, num_chunks-1]
+
+def tfidf_matrix_path(file_id: int) -> str:
+    """Location of a file's TF-IDF matrix (CSC arrays, no pickled objects)."""
+    return os.path.join(settings.INDEX_DIR, f"{file_id}.tfidf.npz")
+
+def tfidf_vocabulary_path(file_id: int) -> str:
+    """Location of a file's TF-IDF chunk count, vocabulary and idf weights, as JSON."""
+    return os.path.join(settings.INDEX_DIR, f"{file_id}.tfidf.json")
+
+def legacy_tfidf_index_path(file_id: int) -> str:
+    """Pickled index written by earlier versions; never loaded, only removed."""
+    return os.path.join(settings.UPLOAD_DIR, f"{file_id}.tfidf.pkl")
+
+def delete_file_index(file_id: int):
+    """Remove a file's TF-IDF index from disk and from the cache."""
+    invalidate_file_index(file_id)
+    for path in (tfidf_matrix_path(file_id), tfidf_vocabulary_path(file_id), legacy_tfidf_index_path(file_id)):
+        if os.path.exists(path):
+            os.remove(path)
+
+def new_vectorizer(vocabulary: Optional[Dict[str, int]] = None) -> TfidfVectorizer:
+    """TF-IDF vectorizer with the service's analyzer settings, optionally over a fixed vocabulary."""
+    return TfidfVectorizer(stop_words=list(STOP_WORDS), vocabulary=vocabulary)
+
+def save_index(file_id: int, count: int, vectorizer: Optional[TfidfVectorizer], tfidf_matrix):
+    """Persist a fitted index as plain data: the matrix with save_npz, the vocabulary and idf as JSON."""
+    terms = idf = None
+    if vectorizer is not None:
+        scipy.sparse.save_npz(tfidf_matrix_path(file_id), tfidf_matrix, compressed=False)
+        terms = vectorizer.get_feature_names_out().tolist()
+        idf = vectorizer.idf_.tolist()
+    # Written last: an index only counts as saved once its JSON exists
+    with open(tfidf_vocabulary_path(file_id), "w") as f:
+        json.dump({"count": count, "terms": terms, "idf": idf}, f)
+
+def load_saved_index(file_id: int, count: int) -> Optional[tuple]:
+    """(vectorizer, matrix) saved for a file with count chunks, or None if there is no usable one."""
+    path = tfidf_vocabulary_path(file_id)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        saved = json.load(f)
+    if saved["count"] != count:
+        return None
+    if saved["terms"] is None:
+        return None, None
+    
+    # Rebuilt from the fitted vocabulary and idf, so transform matches the original vectorizer
+    vectorizer = new_vectorizer({term: i for i, term in enumerate(saved["terms"])})
+    vectorizer.idf_ = np.asarray(saved["idf"], dtype=np.float64)
+    return vectorizer, scipy.sparse.load_npz(tfidf_matrix_path(file_id)).tocsc()
 
 class SimpleRAGService:
     def __init__(self):
@@ -14,156 +169,223 @@ class SimpleRAGService:
     def store_document_embeddings(self, db: Session, file_id: int, chunks: List[Tuple[str, int, int]]) -> bool:
         """Store document chunks without embeddings (using simple text matching instead)."""
         try:
-            # Store chunks without embeddings for now
-            for i, (chunk_text, start_char, end_char) in enumerate(chunks):
-                chunk_record = DocumentChunk(
-                    file_id=file_id,
-                    chunk_text=chunk_text,
-                    chunk_index=i,
-                    start_char=start_char,
-                    end_char=end_char,
-                    embedding_vector=None  # No embeddings for now
+            # Store chunks without embeddings, all in a single executemany statement
+            rows = [
+                {
+                    "file_id": file_id,
+                    "chunk_text": chunk_text,
+                    "chunk_index": i,
+                    "start_char": start_char,
+                    "end_char": end_char
+                }
+                for i, (chunk_text, start_char, end_char) in enumerate(chunks)
+            ]
+            # Core table insert: one executemany, without ORM bulk-insert bookkeeping
+            if rows:
+                db.execute(insert(DocumentChunk.__table__), rows)
+            
+            # Tokenize and weight the chunks once here, so a cold query only has to read the index back
+            vectorizer, tfidf_matrix = self._fit_index([chunk_text for chunk_text, _, _ in chunks])
+            save_index(file_id, len(rows), vectorizer, tfidf_matrix)
+            
+            # Title suggestions depend only on the document, so build the reply now rather than per question
+            if chunks:
+                title_chunks = [chunks[pos][0] for pos in title_chunk_positions(len(chunks))[:3]]
+                db.execute(
+                    update(UploadedFile).where(UploadedFile.id == file_id).values(
+                        suggested_titles=self._suggest_title(title_chunks)
+                    )
                 )
-                db.add(chunk_record)
             
             db.commit()
+            invalidate_file_index(file_id)
             return True
         except Exception as e:
             print(f"Error storing document chunks: {str(e)}")
             db.rollback()
+            delete_file_index(file_id)
             return False
     
+    async def astore_document_embeddings(self, db: Session, file_id: int, chunks: List[Tuple[str, int, int]]) -> bool:
+        """store_document_embeddings on a worker thread, for the same async interface as RAGService."""
+        return await run_in_threadpool(self.store_document_embeddings, db, file_id, chunks)
+    
     def retrieve_relevant_chunks(self, db: Session, file_id: int, query: str) -> List[Tuple[str, float]]:
-        """Retrieve relevant chunks using improved keyword matching."""
+        """Retrieve relevant chunks by TF-IDF cosine similarity."""
+        return [(text, score) for _, text, score in self._retrieve_context(db, file_id, query)]
+    
+    def _retrieve_context(self, db: Session, file_id: int, query: str,
+                          intents: Optional[FrozenSet[str]] = None) -> List[Tuple[int, str, float]]:
+        """Retrieve (chunk id, text, score) for the most relevant chunks."""
+        # Ranking only ever looks at the lowercased query, so repeats of it share one result
+        cache_key = (file_id, query.lower().strip())
+        with _index_cache_lock:
+            cached = _result_cache.get(cache_key)
+            if cached is not None and _index_cache.get(file_id) is cached[0]:
+                _result_cache.move_to_end(cache_key)
+                return list(cached[1])
+        
+        if intents is None:
+            intents = query_intents(query)
         try:
-            # Get all chunks for the file
-            chunks = db.query(DocumentChunk).filter(DocumentChunk.file_id == file_id).all()
-            if not chunks:
+            # Get the file's chunk ids with their TF-IDF index
+            index_entry = self._load_index(db, file_id)
+            chunk_ids, vectorizer, tfidf_matrix = index_entry
+            if not chunk_ids:
                 return []
             
-            query_lower = query.lower()
-            relevant_chunks = []
-            
-            # Handle specific queries
-            if any(word in query_lower for word in ['first page', '1st page', 'page 1', 'beginning', 'start']):
-                # Return first few chunks for page-related queries
-                for i, chunk in enumerate(chunks[:3]):
-                    similarity = 1.0 - (i * 0.1)  # Higher score for earlier chunks
-                    relevant_chunks.append((chunk.chunk_text, similarity))
-                return relevant_chunks
-            
-            # Handle title/naming queries - get diverse chunks from document
-            if any(word in query_lower for word in ['title', 'suggest title', 'name for', 'call this document']):
-                # Get chunks from different parts of the document for better title analysis
-                chunk_indices = [0, len(chunks)//3, len(chunks)//2, len(chunks)*2//3, len(chunks)-1]
-                for i, idx in enumerate(chunk_indices[:5]):
-                    if idx < len(chunks):
-                        similarity = 0.9 - (i * 0.1)
-                        relevant_chunks.append((chunks[idx].chunk_text, similarity))
-                return relevant_chunks
-            
-            # Extract meaningful words (remove common stop words)
-            stop_words = {'the', 'a', 'an', 'and', 'or', 'but', 'in', 'on', 'at', 'to', 'for', 'of', 'with', 'by', 'is', 'are', 'was', 'were', 'be', 'been', 'have', 'has', 'had', 'do', 'does', 'did', 'will', 'would', 'could', 'should', 'may', 'might', 'can', 'what', 'where', 'when', 'why', 'how', 'there', 'here', 'this', 'that', 'these', 'those'}
-            query_words = set(re.findall(r'\w+', query_lower)) - stop_words
-            
-            # If no meaningful words, return first few chunks
-            if not query_words:
-                for i, chunk in enumerate(chunks[:3]):
-                    similarity = 0.8 - (i * 0.1)
-                    relevant_chunks.append((chunk.chunk_text, similarity))
-                return relevant_chunks
-            
-            for chunk in chunks:
-                chunk_text_lower = chunk.chunk_text.lower()
-                chunk_words = set(re.findall(r'\w+', chunk_text_lower)) - stop_words
-                
-                # Multiple scoring methods
-                scores = []
-                
-                # 1. Exact phrase matching
-                if query_lower in chunk_text_lower:
-                    scores.append(1.0)
-                
-                # 2. Word overlap scoring
-                if query_words and chunk_words:
-                    common_words = query_words.intersection(chunk_words)
-                    if common_words:
-                        word_similarity = len(common_words) / len(query_words)
-                        scores.append(word_similarity)
-                
-                # 3. Partial word matching (for variations)
-                partial_matches = 0
-                for query_word in query_words:
-                    for chunk_word in chunk_words:
-                        if query_word in chunk_word or chunk_word in query_word:
-                            partial_matches += 1
-                            break
-                
-                if partial_matches > 0 and query_words:
-                    partial_similarity = partial_matches / len(query_words)
-                    scores.append(partial_similarity * 0.7)  # Lower weight for partial matches
-                
-                # 4. Length bonus for substantial chunks
-                if len(chunk.chunk_text) > 100:
-                    scores.append(0.1)  # Small bonus for longer chunks
-                
-                # Use the best score
-                if scores:
-                    final_score = max(scores)
-                    relevant_chunks.append((chunk.chunk_text, final_score))
-            
-            # If no matches found, return first few chunks as fallback
-            if not relevant_chunks:
-                for i, chunk in enumerate(chunks[:3]):
-                    similarity = 0.5 - (i * 0.1)  # Lower base score for fallback
-                    relevant_chunks.append((chunk.chunk_text, similarity))
+            # Rank chunk positions first, then fetch text only for the chosen chunks
+            picks = self._rank_chunks(query, intents, len(chunk_ids), vectorizer, tfidf_matrix)
+            texts = fetch_chunk_texts(db, [chunk_ids[pos] for pos, _ in picks])
+            results = [(chunk_ids[pos], texts[chunk_ids[pos]], score) for pos, score in picks if chunk_ids[pos] in texts]
             
-            # Sort by similarity and return top 5
-            relevant_chunks.sort(key=lambda x: x[1], reverse=True)
-            return relevant_chunks[:5]
+            with _index_cache_lock:
+                _result_cache[cache_key] = (index_entry, results)
+                while len(_result_cache) > RESULT_CACHE_SIZE:
+                    _result_cache.popitem(last=False)
+            return list(results)
         
         except Exception as e:
             print(f"Error retrieving relevant chunks: {str(e)}")
             # Return first chunk as absolute fallback
-            chunks = db.query(DocumentChunk).filter(DocumentChunk.file_id == file_id).limit(1).all()
-            if chunks:
-                return [(chunks[0].chunk_text, 0.3)]
+            first_chunk = self._first_chunk(db, file_id)
+            if first_chunk:
+                return [(first_chunk.id, first_chunk.chunk_text, 0.3)]
             return []
     
-    def generate_answer(self, db: Session, session_id: str, query: str) -> str:
-        """Generate answer using simple template-based approach."""
+    def _first_chunk(self, db: Session, file_id: int):
+        """The file's first chunk as an (id, chunk_text) row, or None, using the cache."""
+        with _index_cache_lock:
+            cached = _first_chunk_cache.get(file_id)
+            if cached is not None:
+                _first_chunk_cache.move_to_end(file_id)
+                return cached
+            generation = _index_generation
+        
+        # Only the two columns are read, and the (file_id, chunk_index) index gives the first row directly
+        first_chunk = db.query(DocumentChunk.id, DocumentChunk.chunk_text).filter(
+            DocumentChunk.file_id == file_id
+        ).order_by(DocumentChunk.chunk_index).first()
+        if first_chunk is not None:
+            with _index_cache_lock:
+                if _index_generation == generation:
+                    _first_chunk_cache[file_id] = first_chunk
+                    while len(_first_chunk_cache) > FIRST_CHUNK_CACHE_SIZE:
+                        _first_chunk_cache.popitem(last=False)
+        return first_chunk
+    
+    def _rank_chunks(self, query: str, intents: FrozenSet[str], num_chunks: int,
+                     vectorizer, tfidf_matrix) -> List[Tuple[int, float]]:
+        """Pick (chunk position, score) pairs for a query."""
+        # Handle specific queries
+        if 'beginning' in intents:
+            # Return first few chunks for page-related queries
+            return [(i, 1.0 - (i * 0.1)) for i in range(min(3, num_chunks))]  # Higher score for earlier chunks
+        
+        # Handle title/naming queries - get diverse chunks from document
+        if 'title' in intents:
+            # Get chunks from different parts of the document for better title analysis
+            return [(idx, 0.9 - (i * 0.1)) for i, idx in enumerate(title_chunk_positions(num_chunks))]
+        
+        # If no meaningful words, return first few chunks
+        if vectorizer is None:
+            return [(i, 0.8 - (i * 0.1)) for i in range(min(3, num_chunks))]
+        
+        # Rows are L2-normalized, so this is cosine similarity. The matrix is column-major,
+        # so each query term's column is its posting list and only those postings are read
+        query_vec = vectorizer.transform([query])
+        picks = []
+        # The fitted vocabulary is an exact membership test, so a query with no known terms skips scoring
+        if query_vec.nnz:
+            scores = tfidf_matrix[:, query_vec.indices] @ query_vec.data
+            picks = [(int(idx), float(scores[idx])) for idx in top_k_indices(scores, 5) if scores[idx] > 0]
+        elif not vectorizer.build_analyzer()(query):
+            # Only re-analyze on a miss, to tell a query of nothing but stop words from unknown words
+            return [(i, 0.8 - (i * 0.1)) for i in range(min(3, num_chunks))]
+        
+        # If no matches found, return first few chunks as fallback
+        if not picks:
+            picks = [(i, 0.5 - (i * 0.1)) for i in range(min(3, num_chunks))]  # Lower base score for fallback
+        return picks
+    
+    def _load_index(self, db: Session, file_id: int):
+        """Get a file's chunk ids, fitted vectorizer and TF-IDF matrix, using the cache."""
+        with _index_cache_lock:
+            cached = _index_cache.get(file_id)
+            if cached is not None:
+                _index_cache.move_to_end(file_id)
+                return cached
+            generation = _index_generation
+        
+        chunk_ids = [row.id for row in db.query(DocumentChunk.id).filter(
+            DocumentChunk.file_id == file_id
+        ).order_by(DocumentChunk.chunk_index).yield_per(1024)]
+        if not chunk_ids:
+            return [], None, None
+        
+        index = load_saved_index(file_id, len(chunk_ids))
+        if index is None:
+            # Files ingested before indexes were saved: fit from the stored texts
+            index = self._fit_index(row.chunk_text for row in db.query(DocumentChunk.chunk_text).filter(
+                DocumentChunk.file_id == file_id
+            ).order_by(DocumentChunk.chunk_index).yield_per(1024))
+        
+        entry = (chunk_ids, *index)
+        with _index_cache_lock:
+            if _index_generation == generation:
+                _index_cache[file_id] = entry
+                while len(_index_cache) > INDEX_CACHE_SIZE:
+                    _index_cache.popitem(last=False)
+        return entry
+    
+    def _fit_index(self, chunk_texts):
+        """Fit a TF-IDF vectorizer over chunk texts. Returns (vectorizer, matrix), both None if nothing is left."""
+        vectorizer = new_vectorizer()
+        try:
+            # CSC: one contiguous posting list (chunk rows and weights) per term
+            return vectorizer, vectorizer.fit_transform(chunk_texts).tocsc()
+        except ValueError:
+            # Nothing but stop words (or no chunks) in the document
+            return None, None
+    
+    def generate_answer(self, db: Session, session_id: str, query: str) -> Optional[str]:
+        """Generate answer using simple template-based approach. Returns None if the session does not exist."""
         try:
-            # Get chat session and file
-            session = db.query(ChatSession).filter(ChatSession.session_id == session_id).first()
+            # Get chat session's file, with its precomputed title suggestions
+            session = db.query(ChatSession.file_id, UploadedFile.suggested_titles).join(
+                UploadedFile, UploadedFile.id == ChatSession.file_id
+            ).filter(ChatSession.session_id == session_id).first()
             if not session:
-                return "Session not found. Please start a new conversation."
+                return None
             
-            # Debug: Check how many chunks we have
-            total_chunks = db.query(DocumentChunk).filter(DocumentChunk.file_id == session.file_id).count()
-            print(f"Debug: Found {total_chunks} chunks for file_id {session.file_id}")
+            # Classified once; both retrieval and the response template branch on it
+            intents = query_intents(query)
             
             # Retrieve relevant chunks
-            relevant_chunks = self.retrieve_relevant_chunks(db, session.file_id, query)
+            relevant_chunks = self._retrieve_context(db, session.file_id, query, intents)
             print(f"Debug: Query '{query}' returned {len(relevant_chunks)} relevant chunks")
             
             # Generate simple response
             if not relevant_chunks:
                 # Fallback: get first chunk if available
-                first_chunk = db.query(DocumentChunk).filter(DocumentChunk.file_id == session.file_id).first()
+                first_chunk = self._first_chunk(db, session.file_id)
                 if first_chunk:
                     print("Debug: No relevant chunks found, using first chunk as fallback")
-                    relevant_chunks = [(first_chunk.chunk_text, 0.5)]
-                    top_chunks = [chunk[0] for chunk in relevant_chunks]
-                    response = self._create_simple_response(query, top_chunks)
+                    relevant_chunks = [(first_chunk.id, first_chunk.chunk_text, 0.5)]
+                    top_chunks = [chunk[1] for chunk in relevant_chunks]
+                    response = self._create_simple_response(query, top_chunks, intents)
                 else:
                     response = "I couldn't find any content in the uploaded document. Please make sure the document was processed correctly."
+            elif 'title' in intents and 'beginning' not in intents and session.suggested_titles:
+                # Title queries retrieve the same spread of chunks every time, so the reply was built at ingest
+                response = session.suggested_titles
             else:
                 # Create a simple response based on the most relevant chunks
-                top_chunks = [chunk[0] for chunk in relevant_chunks[:3]]
-                response = self._create_simple_response(query, top_chunks)
+                top_chunks = [chunk[1] for chunk in relevant_chunks[:3]]
+                response = self._create_simple_response(query, top_chunks, intents)
             
             # Store the conversation
-            self._store_conversation_turn(db, session_id, query, response, relevant_chunks)
+            store_conversation_turn(db, session_id, query, response, relevant_chunks)
             
             return response
         
@@ -171,64 +393,67 @@ class SimpleRAGService:
             print(f"Error generating answer: {str(e)}")
             return "I encountered an error while processing your question. Please try again."
     
-    def _create_simple_response(self, query: str, chunks: List[str]) -> str:
+    async def agenerate_answer(self, db: Session, session_id: str, query: str) -> Optional[str]:
+        """generate_answer on a worker thread, since ranking is synchronous CPU work."""
+        return await run_in_threadpool(self.generate_answer, db, session_id, query)
+    
+    def _create_simple_response(self, query: str, chunks: List[str],
+                                intents: Optional[FrozenSet[str]] = None) -> str:
         """Create a simple response based on relevant chunks."""
         if not chunks:
             return "I couldn't find relevant information in the document to answer your question."
         
-        query_lower = query.lower()
+        if intents is None:
+            intents = query_intents(query)
         
         # Handle title suggestion queries
-        if any(word in query_lower for word in ['title', 'suggest title', 'name for', 'call this document']):
+        if 'title' in intents:
             return self._suggest_title(chunks)
         
         # Handle specific query types
-        if any(word in query_lower for word in ['first page', '1st page', 'page 1', 'beginning', 'start']):
-            response_parts = [
-                "Here's what I found from the beginning of the document:",
-                ""
-            ]
-        elif any(word in query_lower for word in ['summary', 'summarize', 'overview', 'main points']):
-            response_parts = [
-                "Here's a summary based on the document content:",
-                ""
-            ]
+        if 'beginning' in intents:
+            header = _RESPONSE_HEADERS['beginning']
+        elif 'summary' in intents:
+            header = _RESPONSE_HEADERS['summary']
         elif '?' in query:
-            response_parts = [
-                "Based on your question, here's what I found in the document:",
-                ""
-            ]
+            header = _RESPONSE_HEADERS['question']
         else:
-            response_parts = [
-                "Here's the relevant information from the document:",
-                ""
-            ]
+            header = _RESPONSE_HEADERS['default']
         
         # Add the chunks
-        for i, chunk in enumerate(chunks[:2], 1):
-            # Clean up the chunk text
-            clean_chunk = chunk.strip()
-            
-            # Truncate very long chunks but try to end at sentence boundaries
-            if len(clean_chunk) > 400:
-                # Try to find a good breaking point
-                sentences = re.split(r'[.!?]+', clean_chunk)
-                truncated = ""
-                for sentence in sentences:
-                    if len(truncated + sentence) < 350:
-                        truncated += sentence + ". "
-                    else:
-                        break
-                clean_chunk = truncated.strip() + "..."
-            
-            response_parts.append(f"📄 Section {i}:")
-            response_parts.append(clean_chunk)
-            response_parts.append("")
+        sections = "\n".join(
+            f"📄 Section {i}:\n{self._truncate_chunk(chunk)}\n" for i, chunk in enumerate(chunks[:2], 1)
+        )
+        response = f"{header}\n\n{sections}"
         
         if len(chunks) > 2:
-            response_parts.append("💡 There are additional relevant sections in the document that might contain more information.")
+            response += "\n💡 There are additional relevant sections in the document that might contain more information."
         
-        return "\n".join(response_parts)
+        return response
+    
+    def _truncate_chunk(self, chunk: str) -> str:
+        """Clean up a chunk, truncating very long ones at sentence boundaries where possible."""
+        clean_chunk = chunk.strip()
+        if len(clean_chunk) <= 400:
+            return clean_chunk
+        
+        # Take whole sentences while they fit, scanning no further than the cut and
+        # tracking the length instead of building the string sentence by sentence
+        sentences = []
+        length = 0
+        start = 0
+        for match in _SENT_RE.finditer(clean_chunk):
+            sentence = clean_chunk[start:match.start()]
+            if length + len(sentence) >= 350:
+                break
+            sentences.append(sentence)
+            length += len(sentence) + 2  # Each sentence is rejoined with ". "
+            start = match.end()
+        else:
+            # Text after the last sentence end
+            if length + len(clean_chunk) - start < 350:
+                sentences.append(clean_chunk[start:])
+        return "".join(sentence + ". " for sentence in sentences).strip() + "..."
     
     def _suggest_title(self, chunks: List[str]) -> str:
         """Suggest a title based on document content."""
@@ -241,40 +466,9 @@ class SimpleRAGService:
         # Extract key terms and topics
         key_terms = []
         
-        # Technical document indicators
-        tech_terms = {
-            'api': 'API', 'database': 'Database', 'security': 'Security', 
-            'encryption': 'Security', 'dashboard': 'Dashboard', 'system': 'System',
-            'application': 'Application', 'software': 'Software', 'platform': 'Platform',
-            'architecture': 'Architecture', 'framework': 'Framework', 'service': 'Service',
-            'development': 'Development', 'implementation': 'Implementation',
-            'management': 'Management', 'analysis': 'Analysis', 'report': 'Report',
-            'documentation': 'Documentation', 'guide': 'Guide', 'manual': 'Manual',
-            'specification': 'Specification', 'requirements': 'Requirements',
-            'design': 'Design', 'configuration': 'Configuration', 'deployment': 'Deployment'
-        }
-        
-        # Business document indicators
-        business_terms = {
-            'business': 'Business', 'strategy': 'Strategy', 'plan': 'Plan',
-            'proposal': 'Proposal', 'contract': 'Contract', 'agreement': 'Agreement',
-            'policy': 'Policy', 'procedure': 'Procedure', 'process': 'Process',
-            'workflow': 'Workflow', 'project': 'Project', 'timeline': 'Timeline',
-            'budget': 'Budget', 'financial': 'Financial', 'revenue': 'Revenue',
-            'marketing': 'Marketing', 'sales': 'Sales', 'customer': 'Customer'
-        }
-        
-        # Academic/Research document indicators
-        academic_terms = {
-            'research': 'Research', 'study': 'Study', 'analysis': 'Analysis',
-            'thesis': 'Thesis', 'dissertation': 'Dissertation', 'paper': 'Paper',
-            'journal': 'Journal', 'article': 'Article', 'review': 'Review',
-            'survey': 'Survey', 'experiment': 'Experiment', 'methodology': 'Methodology'
-        }
-        
         # Find matching terms
         found_terms = set()
-        for term, display in {**tech_terms, **business_terms, **academic_terms}.items():
+        for term, display in _TITLE_TERMS.items():
             if term in full_text:
                 found_terms.add(display)
         
@@ -362,35 +556,3 @@ class SimpleRAGService:
         ])
         
         return "\n".join(response_parts)
-    
-    def _store_conversation_turn(self, db: Session, session_id: str, query: str, 
-                                response: str, relevant_chunks: List[Tuple[str, float]]):
-        """Store user query and assistant response."""
-        try:
-            # Store user message
-            user_message = ChatMessage(
-                session_id=session_id,
-                message_type="user",
-                content=query
-            )
-            db.add(user_message)
-            
-            # Store assistant response with context
-            context_info = json.dumps([
-                {"text": chunk[0][:200] + "..." if len(chunk[0]) > 200 else chunk[0], 
-                 "similarity": chunk[1]}
-                for chunk in relevant_chunks[:3]
-            ])
-            
-            assistant_message = ChatMessage(
-                session_id=session_id,
-                message_type="assistant",
-                content=response,
-                context_chunks=context_info
-            )
-            db.add(assistant_message)
-            
-            db.commit()
-        except Exception as e:
-            print(f"Error storing conversation: {str(e)}")
-            db.rollback()
\ No newline at end of file
@@ -1,32 +1,63 @@
 import pytest
-import os
 import tempfile
 import shutil
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+import copy
+from contextlib import contextmanager
+from functools import lru_cache, partial
+from io import BytesIO
+from docx import Document
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import StaticPool
 from fastapi.testclient import TestClient
 
 from backend.database import Base, get_db
 from backend.main import app
 from backend.config import settings
+from backend.embedding_service import EmbeddingService
 
-# Test database
-TEST_DATABASE_URL = "sqlite:///./test_chatbot.db"
+# In-memory test database, private to each process (so to each pytest-xdist worker)
+TEST_DATABASE_URL = "sqlite://"
 
 @pytest.fixture(scope="session")
 def test_engine():
-    """Create test database engine."""
-    engine = create_engine(TEST_DATABASE_URL, connect_args={"check_same_thread": False})
+    """Create test database engine with the schema built once."""
+    # StaticPool keeps the one connection, and with it the in-memory database, for the whole run
+    engine = create_engine(TEST_DATABASE_URL, connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    
+    # pysqlite's own transaction handling breaks SAVEPOINTs, so emit BEGIN ourselves
+    @event.listens_for(engine, "connect")
+    def disable_pysqlite_transactions(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+    
+    @event.listens_for(engine, "begin")
+    def begin_transaction(conn):
+        conn.exec_driver_sql("BEGIN")
+    
     Base.metadata.create_all(bind=engine)
     yield engine
     # Cleanup
-    os.remove("./test_chatbot.db")
+    engine.dispose()
+
+@pytest.fixture(scope="class")
+def class_connection(test_engine):
+    """A connection whose transaction spans one test class and is rolled back after its last test.
+    
+    Rows written on it directly (by class-scoped fixtures) are shared by the class's tests.
+    """
+    connection = test_engine.connect()
+    transaction = connection.begin()
+    yield connection
+    transaction.rollback()
+    connection.close()
 
 @pytest.fixture(scope="function")
-def test_db(test_engine):
-    """Create test database session."""
-    TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=test_engine)
-    session = TestingSessionLocal()
+def test_db(class_connection):
+    """Create a test database session whose changes are rolled back after the test."""
+    # Each test runs in its own SAVEPOINT of the class transaction, and commits inside the
+    # test release a nested one; neither is ever committed
+    savepoint = class_connection.begin_nested()
+    session = Session(bind=class_connection, autoflush=False, join_transaction_mode="create_savepoint")
     
     # Override the get_db dependency
     def override_get_db():
@@ -40,27 +71,34 @@ def test_db(test_engine):
     yield session
     
     # Cleanup
-    session.rollback()
     session.close()
+    savepoint.rollback()
     app.dependency_overrides.clear()
 
-@pytest.fixture(scope="function")
-def client(test_db):
-    """Create test client."""
+@pytest.fixture(scope="session")
+def app_client():
+    """One TestClient for the whole run; it is never entered, so startup hooks stay off the real database."""
     return TestClient(app)
 
+@pytest.fixture(scope="function")
+def client(app_client, test_db):
+    """Test client whose requests see this test's database session."""
+    return app_client
+
 @pytest.fixture(scope="function")
 def temp_upload_dir():
-    """Create temporary upload directory."""
+    """Create temporary upload and index directories; yields the upload directory."""
     temp_dir = tempfile.mkdtemp()
-    original_upload_dir = settings.UPLOAD_DIR
-    settings.UPLOAD_DIR = temp_dir
+    index_dir = tempfile.mkdtemp()
+    original_dirs = settings.UPLOAD_DIR, settings.INDEX_DIR
+    settings.UPLOAD_DIR, settings.INDEX_DIR = temp_dir, index_dir
     
     yield temp_dir
     
     # Cleanup
     shutil.rmtree(temp_dir)
-    settings.UPLOAD_DIR = original_upload_dir
+    shutil.rmtree(index_dir)
+    settings.UPLOAD_DIR, settings.INDEX_DIR = original_dirs
 
 @pytest.fixture
 def sample_docx_content():
@@ -73,4 +111,87 @@ def mock_hf_api_key():
     original_key = settings.HF_API_KEY
     settings.HF_API_KEY = "test_api_key"
     yield "test_api_key"
-    settings.HF_API_KEY = original_key
\ No newline at end of file
+    settings.HF_API_KEY = original_key
+
+# Document() unzips and parses python-docx's default template; copying a parsed one is cheaper
+_DOCX_TEMPLATE = Document()
+
+@lru_cache(maxsize=None)
+def _build_docx(paragraphs: tuple) -> bytes:
+    """Serialize a Word document with the given paragraphs."""
+    doc = copy.deepcopy(_DOCX_TEMPLATE)
+    for paragraph in paragraphs:
+        doc.add_paragraph(paragraph)
+    
+    file_bytes = BytesIO()
+    doc.save(file_bytes)
+    return file_bytes.getvalue()
+
+@pytest.fixture(scope="session")
+def docx_factory():
+    """Build Word document bytes from a list of paragraphs, once per distinct content."""
+    def build(paragraphs):
+        return _build_docx(tuple(paragraphs))
+    return build
+
+@pytest.fixture
+def blank_docx():
+    """A fresh copy of the default Word template, for tests that add tables or runs themselves."""
+    return copy.deepcopy(_DOCX_TEMPLATE)
+
+@pytest.fixture(scope="session")
+def embedding_service():
+    """One EmbeddingService, with its HTTP session, for the whole test run."""
+    return EmbeddingService()
+
+@contextmanager
+def record_statements(engine):
+    """Collect the SQL statements sent through an engine while the block runs."""
+    statements = []
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        # SAVEPOINT bookkeeping comes from the test_db fixture, not the code under test
+        if "SAVEPOINT" not in statement:
+            statements.append(statement)
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+
+@pytest.fixture
+def count_queries(test_engine):
+    """Context manager that collects the SQL statements sent to the test database."""
+    return partial(record_statements, test_engine)
+
+def pytest_addoption(parser):
+    parser.addoption(
+        "--count-queries", action="store_true",
+        help="fail tests marked max_queries(n) whose body sends more than n SQL statements"
+    )
+
+def pytest_configure(config):
+    config.addinivalue_line(
+        "markers", "max_queries(n): SQL statement budget for the test body, checked with --count-queries"
+    )
+
+@pytest.hookimpl(hookwrapper=True)
+def pytest_runtest_call(item):
+    """Count the statements of tests marked max_queries when --count-queries is set."""
+    marker = item.get_closest_marker("max_queries")
+    if marker is None or not item.config.getoption("count_queries"):
+        yield
+        return
+    
+    # Only the test body is counted; fixture setup has already run
+    engine = item.funcargs.get("test_engine")
+    if engine is None:
+        raise pytest.UsageError(f"{item.nodeid}: max_queries needs the test_db fixture")
+    with record_statements(engine) as statements:
+        outcome = yield
+    
+    limit = marker.args[0]
+    if outcome.excinfo is None and len(statements) > limit:
+        listing = "\n".join(statements)
+        outcome.force_exception(pytest.fail.Exception(
+            f"{len(statements)} SQL statements, max_queries allows {limit}:\n{listing}", pytrace=False
+        ))
\ No newline at end of file
@@ -2,25 +2,40 @@ import pytest
 import os
 import tempfile
 import json
-from io import BytesIO
-from docx import Document
 from fastapi.testclient import TestClient
+from sqlalchemy.exc import OperationalError
 
 from backend.models import UploadedFile, ChatSession, ChatMessage
+from backend.config import settings
+from backend import simple_rag
+from backend.simple_rag import SimpleRAGService, invalidate_file_index
+from backend.main import backfill_content_hashes, document_processor
+from backend.document_processor import CONTENT_HASH_ALGO
+
+DOCX_MIME = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
 
 class TestAPIEndpoints:
     
+    @pytest.fixture(autouse=True)
+    def _docx_factory(self, docx_factory):
+        self.docx_factory = docx_factory
+    
+    @pytest.fixture
+    def uploaded_file_id(self, client, temp_upload_dir, test_db):
+        """Id of a one-paragraph test.docx uploaded through the API."""
+        content, filename = self.create_test_docx_file(["Test content."])
+        response = client.post("/api/upload", files={"files": (filename, content, DOCX_MIME)})
+        return response.json()["uploaded_files"][0]["id"]
+    
+    @pytest.fixture
+    def chat_session_id(self, client, uploaded_file_id):
+        """Id of a chat session started on the uploaded file."""
+        response = client.post("/api/chat/start", data={"file_id": uploaded_file_id})
+        return response.json()["session_id"]
+    
     def create_test_docx_file(self, content_paragraphs, filename="test.docx"):
         """Create a test Word document file."""
-        doc = Document()
-        for paragraph in content_paragraphs:
-            doc.add_paragraph(paragraph)
-        
-        file_bytes = BytesIO()
-        doc.save(file_bytes)
-        file_bytes.seek(0)
-        
-        return file_bytes.getvalue(), filename
+        return self.docx_factory(content_paragraphs), filename
     
     def test_health_check(self, client):
         """Test health check endpoint."""
@@ -34,19 +49,27 @@ class TestAPIEndpoints:
         assert "upload_dir" in data
         assert "max_file_size" in data
     
-    def test_upload_single_file(self, client, temp_upload_dir, test_db):
+    def test_upload_single_file(self, client, temp_upload_dir, test_db, count_queries, monkeypatch):
         """Test uploading a single Word document."""
         content, filename = self.create_test_docx_file([
             "This is a test document.",
             "It contains multiple paragraphs.",
             "This is for testing purposes."
         ])
+        # Small chunks so the document yields several of them
+        monkeypatch.setattr("backend.main.document_processor.chunk_size", 4)
+        monkeypatch.setattr("backend.main.document_processor.chunk_overlap", 1)
         
-        files = {"files": (filename, content, "application/vnd.openxmlformats-officedocument.wordprocessingml.document")}
+        files = {"files": (filename, content, DOCX_MIME)}
         
-        response = client.post("/api/upload", files=files)
+        with count_queries() as queries:
+            response = client.post("/api/upload", files=files)
         assert response.status_code == 200
         
+        # All chunks go in with one executemany
+        chunk_inserts = [q for q in queries if q.startswith("INSERT INTO document_chunks")]
+        assert len(chunk_inserts) == 1
+        
         data = response.json()
         assert "uploaded_files" in data
         assert "errors" in data
@@ -57,7 +80,7 @@ class TestAPIEndpoints:
         uploaded_file = data["uploaded_files"][0]
         assert uploaded_file["filename"] == filename
         assert uploaded_file["text_length"] > 0
-        assert uploaded_file["chunks_count"] > 0
+        assert uploaded_file["chunks_count"] > 1
         
         # Verify file is in database
         db_file = test_db.query(UploadedFile).first()
@@ -72,7 +95,7 @@ class TestAPIEndpoints:
         ]
         
         files = [
-            ("files", (filename, content, "application/vnd.openxmlformats-officedocument.wordprocessingml.document"))
+            ("files", (filename, content, DOCX_MIME))
             for content, filename in files_data
         ]
         
@@ -88,9 +111,40 @@ class TestAPIEndpoints:
         db_files = test_db.query(UploadedFile).all()
         assert len(db_files) == 2
     
-    def test_upload_invalid_file_type(self, client, temp_upload_dir):
+    def test_upload_continues_after_failed_flush(self, client, temp_upload_dir, test_db, monkeypatch):
+        """Test that a file whose row can't be flushed doesn't break the files after it."""
+        test_db.add(UploadedFile(filename="x.docx", original_filename="existing.docx", file_path="/gone/x.docx",
+                                 text_length=1, content_hash="taken", hash_algo=CONTENT_HASH_ALGO))
+        test_db.commit()
+        
+        # The first file's hash collides with the stored one only after the duplicate check
+        process_document = document_processor.process_document
+        def colliding_first(file_path, content_hash=None):
+            text, chunks, content_hash = process_document(file_path, content_hash)
+            return text, chunks, "taken" if "colliding" in text else content_hash
+        monkeypatch.setattr(document_processor, "process_document", colliding_first)
+        
+        files = [
+            ("files", ("first.docx", self.docx_factory(["colliding content"]), DOCX_MIME)),
+            ("files", ("second.docx", self.docx_factory(["Second document content."]), DOCX_MIME)),
+        ]
+        data = client.post("/api/upload", files=files).json()
+        
+        assert data["success_count"] == 1
+        assert data["uploaded_files"][0]["filename"] == "second.docx"
+        assert data["errors"][0].startswith("first.docx: Processing error")
+        assert sorted(os.listdir(temp_upload_dir)) == [os.path.basename(
+            test_db.query(UploadedFile.file_path).filter(UploadedFile.original_filename == "second.docx").scalar()
+        )]
+    
+    @pytest.mark.parametrize("filename, content, content_type", [
+        ("test.txt", b"This is a text file", "text/plain"),
+        ("test.pdf", b"%PDF-1.4", "application/pdf"),
+        ("docx", b"No extension", DOCX_MIME),
+    ])
+    def test_upload_invalid_file_type(self, client, temp_upload_dir, filename, content, content_type):
         """Test uploading non-Word document."""
-        files = {"files": ("test.txt", b"This is a text file", "text/plain")}
+        files = {"files": (filename, content, content_type)}
         
         response = client.post("/api/upload", files=files)
         assert response.status_code == 200
@@ -101,26 +155,98 @@ class TestAPIEndpoints:
         assert len(data["errors"]) == 1
         assert "Only Word documents" in data["errors"][0]
     
-    def test_upload_duplicate_content(self, client, temp_upload_dir, test_db):
+    def test_upload_file_too_large(self, client, temp_upload_dir, monkeypatch):
+        """Test that oversized uploads are rejected and not left on disk."""
+        content, filename = self.create_test_docx_file(["Content that exceeds the limit."])
+        monkeypatch.setattr(settings, "MAX_FILE_SIZE", len(content) - 1)
+        
+        files = {"files": (filename, content, DOCX_MIME)}
+        response = client.post("/api/upload", files=files)
+        assert response.status_code == 200
+        
+        data = response.json()
+        assert data["success_count"] == 0
+        assert data["error_count"] == 1
+        assert "File too large" in data["errors"][0]
+        assert os.listdir(temp_upload_dir) == []
+    
+    def test_upload_streams_in_chunks(self, client, temp_upload_dir, test_db, monkeypatch):
+        """Test that a file larger than one read chunk is stored intact."""
+        content, filename = self.create_test_docx_file(["Content copied in small pieces."])
+        monkeypatch.setattr("backend.main.UPLOAD_CHUNK_SIZE", 1024)
+        
+        files = {"files": (filename, content, DOCX_MIME)}
+        response = client.post("/api/upload", files=files)
+        assert response.status_code == 200
+        assert response.json()["success_count"] == 1
+        
+        stored_files = os.listdir(temp_upload_dir)
+        docx_files = [name for name in stored_files if name.endswith(".docx")]
+        assert len(docx_files) == 1
+        with open(os.path.join(temp_upload_dir, docx_files[0]), "rb") as stored:
+            assert stored.read() == content
+    
+    def test_upload_duplicate_content(self, client, temp_upload_dir, test_db, count_queries):
         """Test uploading duplicate content."""
         content, filename = self.create_test_docx_file(["Duplicate content test."])
         
         # Upload first file
-        files = {"files": (filename, content, "application/vnd.openxmlformats-officedocument.wordprocessingml.document")}
+        files = {"files": (filename, content, DOCX_MIME)}
         response1 = client.post("/api/upload", files=files)
         assert response1.status_code == 200
         assert response1.json()["success_count"] == 1
         
         # Upload same content with different filename
-        files = {"files": ("duplicate.docx", content, "application/vnd.openxmlformats-officedocument.wordprocessingml.document")}
-        response2 = client.post("/api/upload", files=files)
+        files = {"files": ("duplicate.docx", content, DOCX_MIME)}
+        with count_queries() as queries:
+            response2 = client.post("/api/upload", files=files)
         assert response2.status_code == 200
+        # The duplicate is rejected by one hash lookup, before any extraction or writes
+        assert len(queries) == 1
+        assert queries[0].startswith("SELECT uploaded_files.original_filename")
         
         data = response2.json()
         assert data["success_count"] == 0
         assert data["error_count"] == 1
         assert "Duplicate content" in data["errors"][0]
     
+    def test_duplicate_check_matches_hash_algorithm(self, client, temp_upload_dir, test_db, uploaded_file_id):
+        """Test that a stored hash made by another algorithm doesn't count as a match."""
+        content, _ = self.create_test_docx_file(["Test content."])
+        test_db.get(UploadedFile, uploaded_file_id).hash_algo = "md5"
+        test_db.commit()
+        
+        response = client.post("/api/upload", files={"files": ("again.docx", content, DOCX_MIME)})
+        assert response.json()["success_count"] == 1
+    
+    def test_backfill_rehashes_legacy_rows(self, client, temp_upload_dir, test_db, uploaded_file_id, monkeypatch):
+        """Test that hashes from older releases are replaced by file hashes, or cleared when the file is gone."""
+        legacy = test_db.get(UploadedFile, uploaded_file_id)
+        legacy.content_hash, legacy.hash_algo = "hash-of-extracted-text", None
+        missing = UploadedFile(filename="gone.docx", original_filename="gone.docx",
+                               file_path=os.path.join(temp_upload_dir, "gone.docx"),
+                               text_length=1, content_hash="another-text-hash")
+        test_db.add(missing)
+        test_db.commit()
+        
+        backfill_content_hashes(test_db)
+        
+        assert legacy.content_hash == document_processor.calculate_file_hash(legacy.file_path)
+        assert legacy.hash_algo == CONTENT_HASH_ALGO
+        assert missing.content_hash is None
+        
+        # Both rows are marked done, so the next startup hashes nothing
+        assert missing.hash_algo == CONTENT_HASH_ALGO
+        rehashed = []
+        monkeypatch.setattr(document_processor, "calculate_file_hash", rehashed.append)
+        backfill_content_hashes(test_db)
+        assert rehashed == []
+        
+        # The rehashed row catches a re-upload of the same file
+        content, _ = self.create_test_docx_file(["Test content."])
+        response = client.post("/api/upload", files={"files": ("again.docx", content, DOCX_MIME)})
+        assert "Duplicate content" in response.json()["errors"][0]
+    
     def test_list_files_empty(self, client, test_db):
         """Test listing files when no files uploaded."""
         response = client.get("/api/files")
@@ -130,18 +256,20 @@ class TestAPIEndpoints:
         assert isinstance(data, list)
         assert len(data) == 0
     
-    def test_list_files_with_data(self, client, temp_upload_dir, test_db):
+    def test_list_files_with_data(self, client, temp_upload_dir, test_db, count_queries):
         """Test listing files after uploading."""
         # Upload a file first
         content, filename = self.create_test_docx_file(["Test content for listing."])
-        files = {"files": (filename, content, "application/vnd.openxmlformats-officedocument.wordprocessingml.document")}
+        files = {"files": (filename, content, DOCX_MIME)}
         
         upload_response = client.post("/api/upload", files=files)
         assert upload_response.status_code == 200
         
         # List files
-        response = client.get("/api/files")
+        with count_queries() as queries:
+            response = client.get("/api/files")
         assert response.status_code == 200
+        assert len(queries) == 1
         
         data = response.json()
         assert len(data) == 1
@@ -152,14 +280,10 @@ class TestAPIEndpoints:
         assert "upload_timestamp" in file_info
         assert file_info["text_length"] > 0
     
-    def test_start_chat_session(self, client, temp_upload_dir, test_db):
+    @pytest.mark.max_queries(4)
+    def test_start_chat_session(self, client, test_db, uploaded_file_id):
         """Test starting a chat session."""
-        # Upload a file first
-        content, filename = self.create_test_docx_file(["Content for chat testing."])
-        files = {"files": (filename, content, "application/vnd.openxmlformats-officedocument.wordprocessingml.document")}
-        
-        upload_response = client.post("/api/upload", files=files)
-        file_id = upload_response.json()["uploaded_files"][0]["id"]
+        file_id = uploaded_file_id
         
         # Start chat session
         response = client.post("/api/chat/start", data={"file_id": file_id})
@@ -168,7 +292,7 @@ class TestAPIEndpoints:
         data = response.json()
         assert "session_id" in data
         assert data["file_id"] == file_id
-        assert data["filename"] == filename
+        assert data["filename"] == "test.docx"
         
         # Verify session in database
         session = test_db.query(ChatSession).first()
@@ -197,21 +321,11 @@ class TestAPIEndpoints:
         data = response.json()
         assert "Chat session not found" in data["detail"]
     
-    def test_chat_empty_message(self, client, temp_upload_dir, test_db):
+    def test_chat_empty_message(self, client, test_db, chat_session_id):
         """Test chatting with empty message."""
-        # Setup: upload file and start session
-        content, filename = self.create_test_docx_file(["Test content."])
-        files = {"files": (filename, content, "application/vnd.openxmlformats-officedocument.wordprocessingml.document")}
-        
-        upload_response = client.post("/api/upload", files=files)
-        file_id = upload_response.json()["uploaded_files"][0]["id"]
-        
-        session_response = client.post("/api/chat/start", data={"file_id": file_id})
-        session_id = session_response.json()["session_id"]
-        
         # Test empty message
         chat_data = {
-            "session_id": session_id,
+            "session_id": chat_session_id,
             "message": ""
         }
         
@@ -221,6 +335,80 @@ class TestAPIEndpoints:
         data = response.json()
         assert "Message cannot be empty" in data["detail"]
     
+    def test_chat_message_stores_history(self, client, temp_upload_dir, test_db):
+        """Test that a chat turn returns a response and records both messages."""
+        # Setup: upload file and start session
+        content, filename = self.create_test_docx_file(["The project deadline is in March."])
+        files = {"files": (filename, content, DOCX_MIME)}
+        
+        upload_response = client.post("/api/upload", files=files)
+        file_id = upload_response.json()["uploaded_files"][0]["id"]
+        
+        session_response = client.post("/api/chat/start", data={"file_id": file_id})
+        session_id = session_response.json()["session_id"]
+        
+        # Send a message
+        response = client.post("/api/chat", json={"session_id": session_id, "message": "When is the deadline?"})
+        assert response.status_code == 200
+        
+        data = response.json()
+        assert data["session_id"] == session_id
+        assert "deadline" in data["response"]
+        
+        # Both the question and the answer should be in the history
+        history = client.get(f"/api/chat/{session_id}/history").json()
+        assert [msg["message_type"] for msg in history] == ["user", "assistant"]
+        assert history[0]["content"] == "When is the deadline?"
+    
+    def test_chat_turn_not_saved_is_not_answered(self, client, test_db, chat_session_id, monkeypatch):
+        """Test that a turn whose commit fails returns the error reply and leaves no history."""
+        def fail_commit():
+            raise OperationalError("COMMIT", {}, Exception("database is locked"))
+        monkeypatch.setattr(test_db, "commit", fail_commit)
+        
+        response = client.post("/api/chat", json={"session_id": chat_session_id, "message": "What is this about?"})
+        assert response.status_code == 200
+        assert response.json()["response"].startswith("I encountered an error")
+        
+        # The rolled-back messages are gone
+        history = client.get(f"/api/chat/{chat_session_id}/history").json()
+        assert history == []
+    
+    def test_tfidf_index_saved_outside_upload_dir(self, client, temp_upload_dir, test_db, uploaded_file_id,
+                                                  chat_session_id, monkeypatch):
+        """Test that the TF-IDF index is stored as plain data in INDEX_DIR and answers after a cold load."""
+        # Only the upload itself lands in the upload directory
+        assert [name.endswith(".docx") for name in os.listdir(temp_upload_dir)] == [True]
+        assert sorted(os.listdir(settings.INDEX_DIR)) == [f"{uploaded_file_id}.tfidf.json", f"{uploaded_file_id}.tfidf.npz"]
+        with open(os.path.join(settings.INDEX_DIR, f"{uploaded_file_id}.tfidf.json")) as f:
+            saved = json.load(f)
+        assert saved["count"] == 1
+        assert "content" in saved["terms"]
+        
+        # A cold load rebuilds the vectorizer from the saved vocabulary and idf instead of refitting
+        invalidate_file_index(uploaded_file_id)
+        refits = []
+        monkeypatch.setattr(SimpleRAGService, "_fit_index", lambda self, texts: refits.append(texts))
+        response = client.post("/api/chat", json={"session_id": chat_session_id, "message": "Which content?"})
+        assert response.status_code == 200
+        assert "Test content." in response.json()["response"]
+        assert refits == []
+    
+    def test_index_load_racing_an_invalidation_is_not_cached(self, client, temp_upload_dir, test_db,
+                                                            uploaded_file_id, chat_session_id, monkeypatch):
+        """Test that an index loaded across a re-ingest is served once but not kept."""
+        invalidate_file_index(uploaded_file_id)
+        load_saved_index = simple_rag.load_saved_index
+        
+        def load_during_reingest(file_id, count):
+            invalidate_file_index(file_id)
+            return load_saved_index(file_id, count)
+        
+        monkeypatch.setattr(simple_rag, "load_saved_index", load_during_reingest)
+        response = client.post("/api/chat", json={"session_id": chat_session_id, "message": "Which content?"})
+        assert response.status_code == 200
+        assert uploaded_file_id not in simple_rag._index_cache
+    
     def test_get_chat_sessions_empty(self, client, test_db):
         """Test getting chat sessions when none exist."""
         response = client.get("/api/sessions")
@@ -230,29 +418,21 @@ class TestAPIEndpoints:
         assert isinstance(data, list)
         assert len(data) == 0
     
-    def test_get_chat_sessions_with_data(self, client, temp_upload_dir, test_db):
+    def test_get_chat_sessions_with_data(self, client, test_db, count_queries, uploaded_file_id, chat_session_id):
         """Test getting chat sessions after creating some."""
-        # Setup: upload file and start session
-        content, filename = self.create_test_docx_file(["Session test content."])
-        files = {"files": (filename, content, "application/vnd.openxmlformats-officedocument.wordprocessingml.document")}
-        
-        upload_response = client.post("/api/upload", files=files)
-        file_id = upload_response.json()["uploaded_files"][0]["id"]
-        
-        session_response = client.post("/api/chat/start", data={"file_id": file_id})
-        session_id = session_response.json()["session_id"]
-        
         # Get sessions
-        response = client.get("/api/sessions")
+        with count_queries() as queries:
+            response = client.get("/api/sessions")
         assert response.status_code == 200
+        assert len(queries) == 1
         
         data = response.json()
         assert len(data) == 1
         
         session_info = data[0]
-        assert session_info["session_id"] == session_id
-        assert session_info["file_id"] == file_id
-        assert session_info["filename"] == filename
+        assert session_info["session_id"] == chat_session_id
+        assert session_info["file_id"] == uploaded_file_id
+        assert session_info["filename"] == "test.docx"
         assert "created_at" in session_info
     
     def test_get_chat_history_invalid_session(self, client, test_db):
@@ -263,20 +443,11 @@ class TestAPIEndpoints:
         data = response.json()
         assert "Session not found" in data["detail"]
     
-    def test_get_chat_history_empty(self, client, temp_upload_dir, test_db):
+    @pytest.mark.max_queries(2)
+    def test_get_chat_history_empty(self, client, test_db, chat_session_id):
         """Test getting chat history for session with no messages."""
-        # Setup: upload file and start session
-        content, filename = self.create_test_docx_file(["History test content."])
-        files = {"files": (filename, content, "application/vnd.openxmlformats-officedocument.wordprocessingml.document")}
-        
-        upload_response = client.post("/api/upload", files=files)
-        file_id = upload_response.json()["uploaded_files"][0]["id"]
-        
-        session_response = client.post("/api/chat/start", data={"file_id": file_id})
-        session_id = session_response.json()["session_id"]
-        
         # Get history
-        response = client.get(f"/api/chat/{session_id}/history")
+        response = client.get(f"/api/chat/{chat_session_id}/history")
         assert response.status_code == 200
         
         data = response.json()
@@ -291,14 +462,10 @@ class TestAPIEndpoints:
         data = response.json()
         assert "File not found" in data["detail"]
     
-    def test_delete_file_success(self, client, temp_upload_dir, test_db):
+    @pytest.mark.max_queries(6)
+    def test_delete_file_success(self, client, test_db, uploaded_file_id):
         """Test successful file deletion."""
-        # Upload a file first
-        content, filename = self.create_test_docx_file(["Content to be deleted."])
-        files = {"files": (filename, content, "application/vnd.openxmlformats-officedocument.wordprocessingml.document")}
-        
-        upload_response = client.post("/api/upload", files=files)
-        file_id = upload_response.json()["uploaded_files"][0]["id"]
+        file_id = uploaded_file_id
         
         # Delete the file
         response = client.delete(f"/api/files/{file_id}")
@@ -1,7 +1,4 @@
 import pytest
-import os
-import tempfile
-from docx import Document
 from backend.document_processor import DocumentProcessor
 
 class TestDocumentProcessor:
@@ -9,15 +6,27 @@ class TestDocumentProcessor:
     def setup_method(self):
         self.processor = DocumentProcessor()
     
+    @pytest.fixture(autouse=True)
+    def _docx_files(self, docx_factory, blank_docx, tmp_path):
+        self.docx_factory = docx_factory
+        self.blank_docx = blank_docx
+        self.tmp_path = tmp_path
+    
+    def next_docx_path(self):
+        """A path in the test's temporary directory not used by an earlier document."""
+        return self.tmp_path / f"test_{len(list(self.tmp_path.iterdir()))}.docx"
+    
     def create_test_docx(self, content_paragraphs):
         """Create a test Word document with given content."""
-        doc = Document()
-        for paragraph in content_paragraphs:
-            doc.add_paragraph(paragraph)
-        
-        temp_file = tempfile.NamedTemporaryFile(delete=False, suffix='.docx')
-        doc.save(temp_file.name)
-        return temp_file.name
+        docx_path = self.next_docx_path()
+        docx_path.write_bytes(self.docx_factory(content_paragraphs))
+        return str(docx_path)
+    
+    def save_test_docx(self, doc):
+        """Save a Word document the test built from blank_docx."""
+        docx_path = self.next_docx_path()
+        doc.save(str(docx_path))
+        return str(docx_path)
     
     def test_extract_text_from_docx(self):
         """Test text extraction from Word document."""
@@ -29,29 +38,59 @@ class TestDocumentProcessor:
         
         docx_path = self.create_test_docx(test_content)
         
-        try:
-            extracted_text = self.processor.extract_text_from_docx(docx_path)
-            
-            # Check that all paragraphs are extracted
-            for paragraph in test_content:
-                assert paragraph in extracted_text
-            
-            # Check that paragraphs are separated by double newlines
-            assert "\n\n" in extracted_text
-            
-        finally:
-            os.unlink(docx_path)
+        extracted_text = self.processor.extract_text_from_docx(docx_path)
+        
+        # Check that all paragraphs are extracted
+        for paragraph in test_content:
+            assert paragraph in extracted_text
+        
+        # Check that paragraphs are separated by double newlines
+        assert "\n\n" in extracted_text
+    
+    def test_extract_text_from_docx_table(self):
+        """Test that table rows are extracted with empty cells skipped."""
+        doc = self.blank_docx
+        doc.add_paragraph("Intro paragraph.")
+        table = doc.add_table(rows=2, cols=3)
+        table.rows[0].cells[0].text = "Name"
+        table.rows[0].cells[2].text = "Role"
+        table.rows[1].cells[0].text = "  Alice  "
+        table.rows[1].cells[1].text = "Engineering"
+        table.rows[1].cells[2].text = "Lead"
+        
+        extracted_text = self.processor.extract_text_from_docx(self.save_test_docx(doc))
+        
+        assert extracted_text.split("\n\n") == [
+            "Intro paragraph.",
+            "Name | Role",
+            "Alice | Engineering | Lead"
+        ]
+    
+    def test_extract_text_from_docx_merged_cells_and_breaks(self):
+        """Test that merged cells repeat like python-docx and runs keep tabs and line breaks."""
+        doc = self.blank_docx
+        paragraph = doc.add_paragraph("Tab\there")
+        paragraph.add_run().add_break()
+        paragraph.add_run("next line")
+        table = doc.add_table(rows=2, cols=2)
+        table.cell(0, 0).text = "Header"
+        table.cell(1, 0).text = "A"
+        table.cell(1, 1).text = "B"
+        table.cell(0, 0).merge(table.cell(0, 1))
+        extracted_text = self.processor.extract_text_from_docx(self.save_test_docx(doc))
+        
+        assert extracted_text.split("\n\n") == [
+            "Tab\there\nnext line",
+            "Header | Header",
+            "A | B"
+        ]
     
     def test_extract_text_from_empty_docx(self):
         """Test text extraction from empty document."""
         docx_path = self.create_test_docx([])
         
-        try:
-            extracted_text = self.processor.extract_text_from_docx(docx_path)
-            assert extracted_text == ""
-            
-        finally:
-            os.unlink(docx_path)
+        extracted_text = self.processor.extract_text_from_docx(docx_path)
+        assert extracted_text == ""
     
     def test_chunk_text_small_text(self):
         """Test chunking with text smaller than chunk size."""
@@ -80,6 +119,14 @@ class TestDocumentProcessor:
             assert len(chunk_words) <= self.processor.chunk_size
             assert start_char < end_char
     
+    def test_chunk_text_exact_chunk_size_newline_separated(self):
+        """Test the word-count cutoff with words that are not separated by spaces."""
+        text = "\n".join(["word"] * self.processor.chunk_size)
+        assert self.processor.chunk_text(text) == [(text, 0, len(text))]
+        
+        text += "\nextra"
+        assert len(self.processor.chunk_text(text)) > 1
+    
     def test_chunk_text_empty(self):
         """Test chunking empty text."""
         chunks = self.processor.chunk_text("")
@@ -105,6 +152,23 @@ class TestDocumentProcessor:
             # There should be some overlap
             assert len(set(overlap_words) & set(second_chunk_start_words)) > 0
     
+    def test_chunk_text_offsets_match_source(self):
+        """Test that chunk character offsets point back into the original text."""
+        words = ["word{}".format(i) for i in range(self.processor.chunk_size * 2)]
+        text = "\n\n".join("\t".join(words[i:i + 10]) for i in range(0, len(words), 10))
+        
+        chunks = self.processor.chunk_text(text)
+        
+        assert len(chunks) > 1
+        for chunk_text, start_char, end_char in chunks:
+            # Newlines and tabs in the source collapse to single spaces in the chunk
+            assert chunk_text == " ".join(text[start_char:end_char].split())
+            assert "\n" not in chunk_text and "\t" not in chunk_text
+        
+        # Every word should be covered and the last chunk should end the text
+        assert chunks[0][1] == 0
+        assert chunks[-1][2] == len(text)
+    
     def test_calculate_content_hash(self):
         """Test content hash calculation."""
         text1 = "This is some test content."
@@ -135,31 +199,37 @@ class TestDocumentProcessor:
         
         docx_path = self.create_test_docx(test_content)
         
-        try:
-            text, chunks, content_hash = self.processor.process_document(docx_path)
-            
-            # Check extracted text
-            assert isinstance(text, str)
-            assert len(text) > 0
-            for paragraph in test_content:
-                assert paragraph in text
-            
-            # Check chunks
-            assert isinstance(chunks, list)
-            assert len(chunks) > 0
-            
-            # Each chunk should be a tuple with (text, start_char, end_char)
-            for chunk in chunks:
-                assert isinstance(chunk, tuple)
-                assert len(chunk) == 3
-                assert isinstance(chunk[0], str)  # chunk text
-                assert isinstance(chunk[1], int)  # start_char
-                assert isinstance(chunk[2], int)  # end_char
-                assert chunk[1] <= chunk[2]  # start <= end
-            
-            # Check content hash
-            assert isinstance(content_hash, str)
-            assert len(content_hash) == 64
-            
-        finally:
-            os.unlink(docx_path)
\ No newline at end of file
+        text, chunks, content_hash = self.processor.process_document(docx_path)
+        
+        # Check extracted text
+        assert isinstance(text, str)
+        assert len(text) > 0
+        for paragraph in test_content:
+            assert paragraph in text
+        
+        # Check chunks
+        assert isinstance(chunks, list)
+        assert len(chunks) > 0
+        
+        # Each chunk should be a tuple with (text, start_char, end_char)
+        for chunk in chunks:
+            assert isinstance(chunk, tuple)
+            assert len(chunk) == 3
+            assert isinstance(chunk[0], str)  # chunk text
+            assert isinstance(chunk[1], int)  # start_char
+            assert isinstance(chunk[2], int)  # end_char
+            assert chunk[1] <= chunk[2]  # start <= end
+        
+        # Check content hash
+        assert isinstance(content_hash, str)
+        assert len(content_hash) == 64
+    
+    def test_process_document_with_precomputed_hash(self):
+        """Test that a hash computed during upload is returned unchanged."""
+        docx_path = self.create_test_docx(["Some content to process."])
+        
+        text, chunks, content_hash = self.processor.process_document(docx_path, "precomputed-hash")
+        
+        assert "Some content to process." in text
+        assert len(chunks) == 1
+        assert content_hash == "precomputed-hash"
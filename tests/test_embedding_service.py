@@ -1,30 +1,94 @@
+import asyncio
+import os
+import subprocess
+import sys
 import pytest
-import json
-from unittest.mock import Mock, patch
-from backend.embedding_service import EmbeddingService
+import numpy as np
+from unittest.mock import AsyncMock, Mock, patch
+from backend.embedding_service import BatchingEmbedder, EmbeddingService, top_k_indices
+from backend.onnx_embedder import OnnxEmbedder
+from backend.simkernel import PARALLEL_THRESHOLD
+
+# Runs the int8 kernel on a worker thread, as the request thread pool does, then exits
+KERNEL_IN_THREAD = """
+import threading
+import numpy as np
+from backend.simkernel import dot_similarities
+worker = threading.Thread(target=dot_similarities, args=(np.ones((4, 8), dtype=np.int8), np.ones(8, dtype=np.int16)))
+worker.start()
+worker.join()
+"""
 
 class TestEmbeddingService:
     
-    def setup_method(self):
-        self.service = EmbeddingService()
+    @pytest.fixture(autouse=True)
+    def _embedding_service(self, embedding_service):
+        # Shared across the session; tests that change it go through monkeypatch
+        self.service = embedding_service
     
-    def test_embedding_to_string(self):
-        """Test converting embedding to JSON string."""
+    def test_embedding_to_bytes(self):
+        """Test converting embedding to float32 bytes."""
         embedding = [0.1, 0.2, 0.3, -0.1, -0.2]
-        result = self.service.embedding_to_string(embedding)
+        result = self.service.embedding_to_bytes(embedding)
         
-        assert isinstance(result, str)
-        # Should be valid JSON
-        parsed = json.loads(result)
-        assert parsed == embedding
+        assert isinstance(result, bytes)
+        # Four bytes per float32 value
+        assert len(result) == len(embedding) * 4
     
-    def test_string_to_embedding(self):
-        """Test converting JSON string back to embedding."""
+    def test_bytes_to_embedding(self):
+        """Test converting float32 bytes back to embedding."""
         embedding = [0.1, 0.2, 0.3, -0.1, -0.2]
-        embedding_str = json.dumps(embedding)
+        embedding_bytes = np.asarray(embedding, dtype=np.float32).tobytes()
         
-        result = self.service.string_to_embedding(embedding_str)
-        assert result == embedding
+        result = self.service.bytes_to_embedding(embedding_bytes)
+        assert result.dtype == np.float32
+        assert result.tolist() == pytest.approx(embedding)
+    
+    def test_bytes_to_embedding_legacy_json(self):
+        """Test that embeddings stored as JSON text before the bytes format still decode."""
+        result = self.service.bytes_to_embedding("[0.5, -0.25, 0.125]")
+        assert result.dtype == np.float32
+        assert result.tolist() == [0.5, -0.25, 0.125]
+    
+    def test_embedding_bytes_round_trip(self):
+        """Test that an embedding survives conversion to bytes and back."""
+        embedding = [0.5, -0.25, 0.125]
+        
+        result = self.service.bytes_to_embedding(self.service.embedding_to_bytes(embedding))
+        assert result.tolist() == embedding
+    
+    def test_normalize_embedding(self):
+        """Test that embeddings are scaled to unit length."""
+        result = self.service.normalize_embedding([3.0, 4.0])
+        
+        assert result.tolist() == pytest.approx([0.6, 0.8])
+        assert float(np.linalg.norm(result)) == pytest.approx(1.0)
+    
+    def test_normalize_embedding_zero_vector(self):
+        """Test that a zero vector is returned unchanged instead of producing NaNs."""
+        result = self.service.normalize_embedding([0.0, 0.0, 0.0])
+        
+        assert result.tolist() == [0.0, 0.0, 0.0]
+    
+    def test_normalize_embeddings(self):
+        """Test row-wise normalization of an embedding matrix."""
+        matrix = np.array([[3.0, 4.0], [0.0, 0.0], [0.0, 2.0]])
+        
+        result = self.service.normalize_embeddings(matrix)
+        
+        assert result.dtype == np.float32
+        np.testing.assert_allclose(result, [[0.6, 0.8], [0.0, 0.0], [0.0, 1.0]], rtol=1e-6)
+    
+    def test_batch_similarities(self):
+        """Test that batch similarities equal cosine similarity for every row."""
+        rng = np.random.default_rng(2)
+        matrix = self.service.normalize_embeddings(rng.standard_normal((20, 8)))
+        query = rng.standard_normal(8)
+        
+        result = self.service.batch_similarities(query, matrix)
+        
+        assert result.shape == (20,)
+        np.testing.assert_allclose(result, matrix @ (query / np.linalg.norm(query)), rtol=1e-5, atol=1e-6)
     
     def test_find_similar_chunks_empty_input(self):
         """Test finding similar chunks with empty input."""
@@ -79,7 +143,69 @@ class TestEmbeddingService:
         similarities = [sim for _, sim in result]
         assert similarities == sorted(similarities, reverse=True)
     
-    @patch('requests.post')
+    def test_top_k_indices(self):
+        """Test that top_k_indices returns the best k indices in descending score order."""
+        scores = np.array([0.2, 0.9, 0.1, 0.7, 0.5])
+        
+        assert top_k_indices(scores, 3).tolist() == [1, 3, 4]
+    
+    def test_top_k_indices_k_exceeds_length(self):
+        """Test that asking for more results than scores returns all of them."""
+        scores = np.array([0.3, 0.8])
+        
+        assert top_k_indices(scores, 5).tolist() == [1, 0]
+        assert top_k_indices(scores, 0).tolist() == []
+    
+    def test_find_similar_chunks_large_matrix(self):
+        """Test that large matrices (JIT kernel path when Numba is installed) rank like a plain dot product."""
+        rng = np.random.default_rng(0)
+        matrix = rng.standard_normal((PARALLEL_THRESHOLD + 10, 16)).astype(np.float32)
+        matrix /= np.linalg.norm(matrix, axis=1, keepdims=True)
+        query = matrix[42] * 2.0
+        
+        result = self.service.find_similar_chunks(query.tolist(), matrix, top_k=3)
+        expected = np.argsort(-(matrix @ self.service.normalize_embedding(query)))[:3]
+        
+        assert [idx for idx, _ in result] == expected.tolist()
+        assert result[0][0] == 42
+        assert result[0][1] == pytest.approx(1.0, abs=1e-5)
+    
+    def test_quantize_embeddings(self):
+        """Test int8 quantization with a scale per row."""
+        matrix = np.array([[1.0, 0.0], [-0.6, 0.8], [0.0, 0.0]], dtype=np.float32)
+        
+        quantized, scales = self.service.quantize_embeddings(matrix)
+        
+        assert quantized.dtype == np.int8
+        assert quantized.tolist() == [[127, 0], [-95, 127], [0, 0]]
+        np.testing.assert_allclose(quantized * scales[:, None], matrix, atol=0.01)
+    
+    @pytest.mark.parametrize("rows", [8, PARALLEL_THRESHOLD + 10])
+    def test_find_similar_chunks_int8_matrix(self, rows):
+        """Test that an int8 matrix ranks like the float32 one it was quantized from."""
+        rng = np.random.default_rng(1)
+        matrix = rng.standard_normal((rows, 16)).astype(np.float32)
+        matrix /= np.linalg.norm(matrix, axis=1, keepdims=True)
+        query = matrix[3] * 2.0
+        
+        quantized, scales = self.service.quantize_embeddings(matrix)
+        result = self.service.find_similar_chunks(query.tolist(), quantized, top_k=3, row_scales=scales)
+        
+        assert result[0][0] == 3
+        assert result[0][1] == pytest.approx(1.0, abs=0.02)
+    
+    def test_kernel_cache_and_thread_pool_exit(self, tmp_path):
+        """Test that kernels run from a worker thread let the process exit, and cache under INDEX_DIR."""
+        pytest.importorskip("numba")
+        env = {key: value for key, value in os.environ.items() if not key.startswith("NUMBA_")}
+        env["INDEX_DIR"] = str(tmp_path)
+        
+        result = subprocess.run([sys.executable, "-c", KERNEL_IN_THREAD], env=env, timeout=120)
+        
+        assert result.returncode == 0
+        assert list((tmp_path / "numba").rglob("*.nbi"))
+    
+    @patch('requests.Session.post')
     def test_get_embedding_success(self, mock_post):
         """Test successful embedding retrieval."""
         # Mock successful API response
@@ -90,10 +216,11 @@ class TestEmbeddingService:
         
         result = self.service.get_embedding("test text")
         
-        assert result == [0.1, 0.2, 0.3, 0.4, 0.5]
+        assert result.dtype == np.float32
+        assert result.tolist() == pytest.approx([0.1, 0.2, 0.3, 0.4, 0.5])
         mock_post.assert_called_once()
     
-    @patch('requests.post')
+    @patch('requests.Session.post')
     def test_get_embedding_api_error(self, mock_post):
         """Test embedding retrieval with API error."""
         # Mock API error response
@@ -107,7 +234,7 @@ class TestEmbeddingService:
         assert result is None
         mock_post.assert_called_once()
     
-    @patch('requests.post')
+    @patch('requests.Session.post')
     def test_get_embedding_network_error(self, mock_post):
         """Test embedding retrieval with network error."""
         # Mock network error
@@ -118,7 +245,7 @@ class TestEmbeddingService:
         assert result is None
         mock_post.assert_called_once()
     
-    @patch('requests.post')
+    @patch('requests.Session.post')
     def test_get_embedding_different_response_format(self, mock_post):
         """Test embedding retrieval with different API response format."""
         # Mock response with embedding in dict format
@@ -129,44 +256,143 @@ class TestEmbeddingService:
         
         result = self.service.get_embedding("test text")
         
-        assert result == [0.1, 0.2, 0.3]
+        assert result.tolist() == pytest.approx([0.1, 0.2, 0.3])
         mock_post.assert_called_once()
     
-    def test_get_embedding_no_api_key(self):
+    def test_aget_embedding_success(self):
+        """Test async single-text embedding retrieval."""
+        mock_response = Mock()
+        mock_response.status_code = 200
+        mock_response.json.return_value = [[0.1, 0.2, 0.3]]
+        
+        with patch('backend.embedding_service._async_client.post', new=AsyncMock(return_value=mock_response)):
+            result = asyncio.run(self.service.aget_embedding("test text"))
+        
+        assert result.dtype == np.float32
+        assert result.tolist() == pytest.approx([0.1, 0.2, 0.3])
+    
+    def test_aget_embeddings_batch_keeps_order(self, monkeypatch):
+        """Test that async batches are sent together and reassembled in order."""
+        monkeypatch.setattr(self.service, "batch_size", 2)
+        
+        async def fake_post(url, headers=None, json=None):
+            response = Mock()
+            response.status_code = 200
+            response.json.return_value = [[float(len(text))] for text in json["inputs"]]
+            return response
+        
+        with patch('backend.embedding_service._async_client.post', new=AsyncMock(side_effect=fake_post)) as mock_post:
+            result = asyncio.run(self.service.aget_embeddings_batch(["a", "bb", "ccc", "dddd", "eeeee"]))
+        
+        assert mock_post.call_count == 3
+        assert [embedding.tolist() for embedding in result] == [[1.0], [2.0], [3.0], [4.0], [5.0]]
+    
+    def test_batching_embedder_coalesces_concurrent_queries(self):
+        """Test that concurrent embed calls share one batch request."""
+        batcher = BatchingEmbedder(self.service)
+        
+        async def embed_all():
+            return await asyncio.gather(*(batcher.embed(text) for text in ["a", "b", "c"]))
+        
+        async def fake_batch(texts):
+            return [[float(len(t))] for t in texts]
+        
+        with patch.object(self.service, 'aget_embeddings_batch', new=AsyncMock(side_effect=fake_batch)) as mock_batch:
+            results = asyncio.run(embed_all())
+        
+        mock_batch.assert_awaited_once_with(["a", "b", "c"])
+        assert results == [[1.0], [1.0], [1.0]]
+    
+    def test_get_embedding_no_api_key(self, monkeypatch):
         """Test embedding retrieval without API key."""
-        # Temporarily remove API key
-        original_key = self.service.api_key
-        self.service.api_key = ""
+        monkeypatch.setattr(self.service, "api_key", "")
         
-        try:
-            with pytest.raises(ValueError, match="HF_API_KEY not provided"):
-                self.service.get_embedding("test text")
-        finally:
-            self.service.api_key = original_key
+        with pytest.raises(ValueError, match="HF_API_KEY not provided"):
+            self.service.get_embedding("test text")
     
-    @patch('requests.post')
+    @patch('requests.Session.post')
     def test_get_embeddings_batch(self, mock_post):
         """Test batch embedding retrieval."""
-        # Mock successful API responses
+        # Mock successful API response with one embedding per input
         mock_response = Mock()
         mock_response.status_code = 200
+        mock_response.json.return_value = [[0.1, 0.2, 0.3], [0.4, 0.5, 0.6]]
+        mock_post.return_value = mock_response
+        
+        texts = ["first text", "second text"]
+        results = self.service.get_embeddings_batch(texts)
+        
+        assert len(results) == 2
+        assert results[0].tolist() == pytest.approx([0.1, 0.2, 0.3])
+        assert results[1].tolist() == pytest.approx([0.4, 0.5, 0.6])
+        # All texts should be sent in a single request
+        mock_post.assert_called_once()
+        assert mock_post.call_args.kwargs['json']['inputs'] == texts
+    
+    @patch('requests.Session.post')
+    def test_get_embeddings_batch_falls_back_to_single_requests(self, mock_post):
+        """Test that a batch answered without one vector per text is retried text by text."""
+        def side_effect(*args, **kwargs):
+            inputs = kwargs['json']['inputs']
+            mock_response = Mock()
+            mock_response.status_code = 200
+            # Only single-text requests get a usable answer
+            mock_response.json.return_value = [[float(len(inputs[0]))]] if len(inputs) == 1 else {"error": "bad"}
+            return mock_response
+        
+        mock_post.side_effect = side_effect
         
+        results = self.service.get_embeddings_batch(["a", "bb"])
+        
+        assert [r.tolist() for r in results] == [[1.0], [2.0]]
+        assert mock_post.call_count == 3
+    
+    @patch('requests.Session.post')
+    def test_get_embeddings_batch_splits_by_batch_size(self, mock_post, monkeypatch):
+        """Test that batch retrieval sends at most batch_size texts per request."""
         def side_effect(*args, **kwargs):
-            # Return different embeddings for different texts
-            payload = kwargs.get('json', {})
-            text = payload.get('inputs', '')
-            if 'first' in text:
-                mock_response.json.return_value = [[0.1, 0.2, 0.3]]
-            else:
-                mock_response.json.return_value = [[0.4, 0.5, 0.6]]
+            mock_response = Mock()
+            mock_response.status_code = 200
+            mock_response.json.return_value = [[float(len(text))] for text in kwargs['json']['inputs']]
             return mock_response
         
         mock_post.side_effect = side_effect
+        monkeypatch.setattr(self.service, "batch_size", 2)
         
-        texts = ["first text", "second text"]
+        texts = ["a", "bb", "ccc"]
         results = self.service.get_embeddings_batch(texts)
         
-        assert len(results) == 2
-        assert results[0] == [0.1, 0.2, 0.3]
-        assert results[1] == [0.4, 0.5, 0.6]
-        assert mock_post.call_count == 2
\ No newline at end of file
+        assert [r.tolist() for r in results] == [[1.0], [2.0], [3.0]]
+        assert mock_post.call_count == 2
+    
+    @patch('requests.Session.post')
+    def test_get_embeddings_batch_api_error(self, mock_post):
+        """Test that a failed batch yields None for each of its texts."""
+        mock_response = Mock()
+        mock_response.status_code = 503
+        mock_response.text = "Service Unavailable"
+        mock_post.return_value = mock_response
+        
+        results = self.service.get_embeddings_batch(["first text", "second text"])
+        
+        assert results == [None, None]
+    
+    @patch('requests.Session.post')
+    def test_get_embeddings_batch_local_model(self, mock_post, monkeypatch):
+        """Test that a local ONNX model is used instead of the API, with padding masked out of the mean."""
+        encodings = [Mock(ids=[1, 2], attention_mask=[1, 1]), Mock(ids=[3, 0], attention_mask=[1, 0])]
+        tokenizer = Mock()
+        tokenizer.encode_batch.return_value = encodings
+        session = Mock()
+        session.get_inputs.return_value = [Mock(), Mock()]
+        session.get_inputs.return_value[0].name = "input_ids"
+        session.get_inputs.return_value[1].name = "attention_mask"
+        # Token embeddings: [batch, tokens, dim]; the second text's padding token must be ignored
+        session.run.return_value = [np.array([[[1.0, 0.0], [3.0, 2.0]], [[4.0, 4.0], [100.0, 100.0]]])]
+        monkeypatch.setattr(self.service, "local_embedder", OnnxEmbedder(session, tokenizer))
+        
+        results = self.service.get_embeddings_batch(["first text", "second"])
+        
+        assert [r.tolist() for r in results] == [[2.0, 1.0], [4.0, 4.0]]
+        assert set(session.run.call_args[0][1]) == {"input_ids", "attention_mask"}
+        mock_post.assert_not_called()
\ No newline at end of file
@@ -1,93 +1,125 @@
 import pytest
 from datetime import datetime
+from sqlalchemy import DateTime, create_engine, func, inspect, insert, select
 from sqlalchemy.exc import IntegrityError
-from backend.models import UploadedFile, DocumentChunk, ChatSession, ChatMessage
+from sqlalchemy.orm import raiseload, selectinload
+from backend.database import create_tables
+from backend.models import UploadedFile, DocumentChunk, ChatSession, ChatMessage, MessageContext
+
+# Columns of the parent file the fixtures create
+PARENT_FILE = {
+    "filename": "test_file.docx",
+    "original_filename": "original_test.docx",
+    "file_path": "/path/to/test_file.docx",
+    "text_length": 1000
+}
+# Built once; values are bound per execution, so every run reuses the cached compiled INSERT
+PARENT_FILE_INSERT = insert(UploadedFile.__table__).returning(UploadedFile.id)
+# Stands in for the shared parent file's id in the creation cases
+FILE_ID = object()
+PARENT_SESSION_ID = "parent-session"
+
+def timestamp_columns(model):
+    """Names of a model's DateTime columns, read from its mapper."""
+    return [column.key for column in inspect(model).columns if isinstance(column.type, DateTime)]
+
+# (model, constructor arguments)
+CREATION_CASES = [
+    pytest.param(UploadedFile, {
+        "filename": "test_file.docx",
+        "original_filename": "original_test.docx",
+        "file_path": "/path/to/test_file.docx",
+        "text_length": 1000,
+        "content_hash": "abc123def456"
+    }, id="uploaded_file"),
+    pytest.param(DocumentChunk, {
+        "file_id": FILE_ID,
+        "chunk_text": "This is a test chunk of text.",
+        "chunk_index": 0,
+        "start_char": 0,
+        "end_char": 29,
+        "embedding_vector": b'\x00\x00\x80?\x00\x00\x00@'
+    }, id="document_chunk"),
+    pytest.param(ChatSession, {
+        "session_id": "test-session-123",
+        "file_id": FILE_ID
+    }, id="chat_session"),
+    pytest.param(ChatMessage, {
+        "session_id": PARENT_SESSION_ID,
+        "message_type": "user",
+        "content": "This is a test message.",
+        "context_chunks": '[{"text": "relevant chunk", "similarity": 0.8}]'
+    }, id="chat_message"),
+]
 
 class TestModels:
     
-    def test_uploaded_file_creation(self, test_db):
-        """Test creating an UploadedFile record."""
-        file_record = UploadedFile(
-            filename="test_file.docx",
-            original_filename="original_test.docx",
-            file_path="/path/to/test_file.docx",
-            text_length=1000,
-            content_hash="abc123def456"
-        )
+    @pytest.fixture(scope="class")
+    def shared_file(self, class_connection):
+        """Id of a parent file shared by the tests that only read it, inserted once per class.
         
+        It is written in the class transaction, outside any test's SAVEPOINT, so it outlives
+        each test's rollback.
+        """
+        return class_connection.execute(PARENT_FILE_INSERT, PARENT_FILE).scalar_one()
+    
+    @pytest.fixture
+    def file_record(self, test_db):
+        """An UploadedFile row of the test's own, for tests that change or delete it."""
+        file_record = UploadedFile(**PARENT_FILE)
         test_db.add(file_record)
+        # A flush assigns the id; the test's own commits persist the row
+        test_db.flush()
+        return file_record
+    
+    @pytest.fixture
+    def parent_session(self, test_db, shared_file):
+        """A ChatSession row on the shared file, for tests that need a parent session."""
+        session = ChatSession(session_id=PARENT_SESSION_ID, file_id=shared_file)
+        test_db.add(session)
+        test_db.flush()
+        return session
+    
+    def row_counts(self, test_db, file_id, session_id):
+        """Row counts of a file, its chunks, a session and that session's messages, in one statement."""
+        # Scoped to the rows under test, so the class's shared file is not counted
+        return tuple(test_db.execute(select(
+            select(func.count()).where(UploadedFile.id == file_id).scalar_subquery(),
+            select(func.count()).where(DocumentChunk.file_id == file_id).scalar_subquery(),
+            select(func.count()).where(ChatSession.session_id == session_id).scalar_subquery(),
+            select(func.count()).where(ChatMessage.session_id == session_id).scalar_subquery()
+        )).one())
+    
+    @pytest.mark.parametrize("model, fields", CREATION_CASES)
+    def test_record_creation(self, test_db, shared_file, parent_session, model, fields):
+        """Test creating a record and reading its columns back."""
+        fields = {name: shared_file if value is FILE_ID else value for name, value in fields.items()}
+        record = model(**fields)
+        
+        test_db.add(record)
         test_db.commit()
-        test_db.refresh(file_record)
+        test_db.refresh(record)
         
-        assert file_record.id is not None
-        assert file_record.filename == "test_file.docx"
-        assert file_record.original_filename == "original_test.docx"
-        assert file_record.file_path == "/path/to/test_file.docx"
-        assert file_record.text_length == 1000
-        assert file_record.content_hash == "abc123def456"
-        assert file_record.upload_timestamp is not None
-        assert isinstance(file_record.upload_timestamp, datetime)
+        assert record.id is not None
+        for name, value in fields.items():
+            assert getattr(record, name) == value
+        for name in timestamp_columns(model):
+            assert isinstance(getattr(record, name), datetime)
     
     def test_uploaded_file_required_fields(self, test_db):
         """Test that required fields are enforced."""
-        # Missing required fields should raise an error
-        file_record = UploadedFile()
-        test_db.add(file_record)
-        
+        # Missing required fields should raise an error; the SAVEPOINT keeps the failure from
+        # poisoning the test's transaction
         with pytest.raises(IntegrityError):
-            test_db.commit()
-    
-    def test_document_chunk_creation(self, test_db):
-        """Test creating a DocumentChunk record."""
-        # First create a file
-        file_record = UploadedFile(
-            filename="test_file.docx",
-            original_filename="original_test.docx",
-            file_path="/path/to/test_file.docx",
-            text_length=1000
-        )
-        test_db.add(file_record)
-        test_db.commit()
-        test_db.refresh(file_record)
-        
-        # Create chunk
-        chunk = DocumentChunk(
-            file_id=file_record.id,
-            chunk_text="This is a test chunk of text.",
-            chunk_index=0,
-            start_char=0,
-            end_char=29,
-            embedding_vector='[0.1, 0.2, 0.3]'
-        )
-        
-        test_db.add(chunk)
-        test_db.commit()
-        test_db.refresh(chunk)
-        
-        assert chunk.id is not None
-        assert chunk.file_id == file_record.id
-        assert chunk.chunk_text == "This is a test chunk of text."
-        assert chunk.chunk_index == 0
-        assert chunk.start_char == 0
-        assert chunk.end_char == 29
-        assert chunk.embedding_vector == '[0.1, 0.2, 0.3]'
+            with test_db.begin_nested():
+                test_db.add(UploadedFile())
+                test_db.flush()
     
-    def test_document_chunk_file_relationship(self, test_db):
+    def test_document_chunk_file_relationship(self, test_db, shared_file, count_queries):
         """Test the relationship between DocumentChunk and UploadedFile."""
-        # Create file
-        file_record = UploadedFile(
-            filename="test_file.docx",
-            original_filename="original_test.docx",
-            file_path="/path/to/test_file.docx",
-            text_length=1000
-        )
-        test_db.add(file_record)
-        test_db.commit()
-        test_db.refresh(file_record)
-        
         # Create chunk
         chunk = DocumentChunk(
-            file_id=file_record.id,
+            file_id=shared_file,
             chunk_text="Test chunk",
             chunk_index=0,
             start_char=0,
@@ -95,135 +127,59 @@ class TestModels:
         )
         test_db.add(chunk)
         test_db.commit()
-        test_db.refresh(chunk)
         
         # Test relationship
-        assert chunk.file == file_record
-        assert chunk in file_record.chunks
-    
-    def test_chat_session_creation(self, test_db):
-        """Test creating a ChatSession record."""
-        # Create file first
-        file_record = UploadedFile(
-            filename="test_file.docx",
-            original_filename="original_test.docx",
-            file_path="/path/to/test_file.docx",
-            text_length=1000
-        )
-        test_db.add(file_record)
-        test_db.commit()
-        test_db.refresh(file_record)
-        
-        # Create session
-        session = ChatSession(
-            session_id="test-session-123",
-            file_id=file_record.id
-        )
+        with count_queries() as queries:
+            file_record = chunk.file
+            assert file_record.id == shared_file
+            assert chunk in file_record.chunks
+        # Reloading the chunk expired by the commit, loading its file, then the file's chunk list
+        assert len(queries) <= 3
         
-        test_db.add(session)
-        test_db.commit()
-        test_db.refresh(session)
-        
-        assert session.id is not None
-        assert session.session_id == "test-session-123"
-        assert session.file_id == file_record.id
-        assert session.created_at is not None
-        assert session.updated_at is not None
-        assert isinstance(session.created_at, datetime)
-        assert isinstance(session.updated_at, datetime)
+        # Eagerly loaded, the chunk list needs no lazy load (raiseload would raise on one)
+        test_db.expire_all()
+        with count_queries() as queries:
+            reloaded = test_db.execute(
+                select(UploadedFile)
+                .options(selectinload(UploadedFile.chunks), raiseload("*"))
+                .where(UploadedFile.id == shared_file)
+            ).scalar_one()
+            assert [c.chunk_text for c in reloaded.chunks] == ["Test chunk"]
+        assert len(queries) == 2
     
-    def test_chat_session_unique_session_id(self, test_db):
+    def test_chat_session_unique_session_id(self, test_db, shared_file):
         """Test that session_id must be unique."""
-        # Create file
-        file_record = UploadedFile(
-            filename="test_file.docx",
-            original_filename="original_test.docx",
-            file_path="/path/to/test_file.docx",
-            text_length=1000
-        )
-        test_db.add(file_record)
-        test_db.commit()
-        test_db.refresh(file_record)
-        
         # Create first session
         session1 = ChatSession(
             session_id="duplicate-session-id",
-            file_id=file_record.id
+            file_id=shared_file
         )
         test_db.add(session1)
-        test_db.commit()
+        test_db.flush()
         
         # Try to create second session with same session_id
         session2 = ChatSession(
             session_id="duplicate-session-id",
-            file_id=file_record.id
+            file_id=shared_file
         )
-        test_db.add(session2)
         
         with pytest.raises(IntegrityError):
-            test_db.commit()
-    
-    def test_chat_message_creation(self, test_db):
-        """Test creating a ChatMessage record."""
-        # Create file and session first
-        file_record = UploadedFile(
-            filename="test_file.docx",
-            original_filename="original_test.docx",
-            file_path="/path/to/test_file.docx",
-            text_length=1000
-        )
-        test_db.add(file_record)
-        test_db.commit()
-        test_db.refresh(file_record)
+            with test_db.begin_nested():
+                test_db.add(session2)
+                test_db.flush()
         
-        session = ChatSession(
-            session_id="test-session-123",
-            file_id=file_record.id
-        )
-        test_db.add(session)
-        test_db.commit()
-        test_db.refresh(session)
-        
-        # Create message
-        message = ChatMessage(
-            session_id=session.session_id,
-            message_type="user",
-            content="This is a test message.",
-            context_chunks='[{"text": "relevant chunk", "similarity": 0.8}]'
-        )
-        
-        test_db.add(message)
-        test_db.commit()
-        test_db.refresh(message)
-        
-        assert message.id is not None
-        assert message.session_id == session.session_id
-        assert message.message_type == "user"
-        assert message.content == "This is a test message."
-        assert message.context_chunks == '[{"text": "relevant chunk", "similarity": 0.8}]'
-        assert message.timestamp is not None
-        assert isinstance(message.timestamp, datetime)
+        # Only the failed insert was rolled back
+        assert test_db.query(ChatSession).count() == 1
     
-    def test_chat_message_session_relationship(self, test_db):
+    def test_chat_message_session_relationship(self, test_db, shared_file, count_queries):
         """Test the relationship between ChatMessage and ChatSession."""
-        # Create file and session
-        file_record = UploadedFile(
-            filename="test_file.docx",
-            original_filename="original_test.docx",
-            file_path="/path/to/test_file.docx",
-            text_length=1000
-        )
-        test_db.add(file_record)
-        test_db.commit()
-        test_db.refresh(file_record)
-        
+        # Create session
         session = ChatSession(
             session_id="test-session-123",
-            file_id=file_record.id
+            file_id=shared_file
         )
         test_db.add(session)
         test_db.commit()
-        test_db.refresh(session)
         
         # Create messages
         message1 = ChatMessage(
@@ -239,30 +195,33 @@ class TestModels:
         
         test_db.add_all([message1, message2])
         test_db.commit()
-        test_db.refresh(message1)
-        test_db.refresh(message2)
         
         # Test relationships
-        assert message1.session == session
-        assert message2.session == session
-        assert message1 in session.messages
-        assert message2 in session.messages
-        assert len(session.messages) == 2
+        with count_queries() as queries:
+            assert message1.session == session
+            assert message2.session == session
+            assert message1 in session.messages
+            assert message2 in session.messages
+            assert len(session.messages) == 2
+        # Per message, a reload after the commit and a session lookup (the foreign key is
+        # session_id, not the primary key, so it can't come from the identity map); then the
+        # message list loads once and is reused
+        assert len(queries) <= 5
+        
+        # Eagerly loaded, the message list needs no lazy load (raiseload would raise on one)
+        test_db.expire_all()
+        with count_queries() as queries:
+            reloaded = test_db.execute(
+                select(ChatSession)
+                .options(selectinload(ChatSession.messages), raiseload("*"))
+                .where(ChatSession.session_id == "test-session-123")
+            ).scalar_one()
+            assert sorted(m.content for m in reloaded.messages) == ["First message", "Response message"]
+        assert len(queries) == 2
     
-    def test_cascade_delete_file(self, test_db):
+    def test_cascade_delete_file(self, test_db, file_record):
         """Test that deleting a file cascades to chunks and sessions."""
-        # Create file with chunks and session
-        file_record = UploadedFile(
-            filename="test_file.docx",
-            original_filename="original_test.docx",
-            file_path="/path/to/test_file.docx",
-            text_length=1000
-        )
-        test_db.add(file_record)
-        test_db.commit()
-        test_db.refresh(file_record)
-        
-        # Add chunk
+        # Add chunk, session and message under the file; the delete commit below is the only one
         chunk = DocumentChunk(
             file_id=file_record.id,
             chunk_text="Test chunk",
@@ -270,37 +229,106 @@ class TestModels:
             start_char=0,
             end_char=10
         )
-        test_db.add(chunk)
-        
-        # Add session with message
         session = ChatSession(
             session_id="test-session-123",
             file_id=file_record.id
         )
-        test_db.add(session)
-        test_db.commit()
-        test_db.refresh(session)
-        
         message = ChatMessage(
             session_id=session.session_id,
             message_type="user",
             content="Test message"
         )
-        test_db.add(message)
-        test_db.commit()
+        test_db.add_all([chunk, session, message])
+        test_db.flush()
         
         # Verify everything exists
-        assert test_db.query(UploadedFile).count() == 1
-        assert test_db.query(DocumentChunk).count() == 1
-        assert test_db.query(ChatSession).count() == 1
-        assert test_db.query(ChatMessage).count() == 1
+        assert self.row_counts(test_db, file_record.id, session.session_id) == (1, 1, 1, 1)
         
         # Delete the file
+        file_id = file_record.id
         test_db.delete(file_record)
         test_db.commit()
         
         # Verify cascade delete worked
-        assert test_db.query(UploadedFile).count() == 0
-        assert test_db.query(DocumentChunk).count() == 0
-        assert test_db.query(ChatSession).count() == 0
-        assert test_db.query(ChatMessage).count() == 0
\ No newline at end of file
+        assert self.row_counts(test_db, file_id, session.session_id) == (0, 0, 0, 0)
+    
+    def test_message_context_relationship(self, test_db, shared_file, count_queries):
+        """Test linking an assistant message to the chunks it used."""
+        # One batched INSERT for all chunks, as the RAG services store them. The ORM unit of
+        # work (like sort_by_parameter_order) inserts one row at a time on SQLite to keep ids in
+        # order, so each id is matched back by its chunk_index instead
+        with count_queries() as queries:
+            chunk_ids = dict(test_db.execute(
+                insert(DocumentChunk.__table__).returning(DocumentChunk.chunk_index, DocumentChunk.id),
+                [{"file_id": shared_file, "chunk_text": f"chunk {i}", "chunk_index": i} for i in range(2)]
+            ).all())
+        assert len(queries) == 1
+        session = ChatSession(session_id="test-session-context", file_id=shared_file)
+        test_db.add(session)
+        test_db.commit()
+        
+        message = ChatMessage(
+            session_id=session.session_id,
+            message_type="assistant",
+            content="Answer",
+            context=[
+                MessageContext(chunk_id=chunk_ids[1], rank=1, similarity=0.4),
+                MessageContext(chunk_id=chunk_ids[0], rank=0, similarity=0.9)
+            ]
+        )
+        test_db.add(message)
+        test_db.commit()
+        test_db.expire(message)
+        
+        # Ordered by rank, with the chunk text reachable through the join
+        assert [ctx.chunk.chunk_text for ctx in message.context] == ["chunk 0", "chunk 1"]
+        assert message.context[0].similarity == 0.9
+
+# Tables as the first release created them, before any columns or indexes were added
+LEGACY_SCHEMA = [
+    """CREATE TABLE uploaded_files (
+        id INTEGER PRIMARY KEY, filename VARCHAR NOT NULL, original_filename VARCHAR NOT NULL,
+        file_path VARCHAR NOT NULL, upload_timestamp DATETIME DEFAULT (CURRENT_TIMESTAMP),
+        text_length INTEGER NOT NULL, content_hash VARCHAR
+    )""",
+    """CREATE TABLE chat_sessions (
+        id INTEGER PRIMARY KEY, session_id VARCHAR NOT NULL, file_id INTEGER NOT NULL,
+        created_at DATETIME DEFAULT (CURRENT_TIMESTAMP), updated_at DATETIME DEFAULT (CURRENT_TIMESTAMP)
+    )""",
+    "INSERT INTO uploaded_files (filename, original_filename, file_path, text_length, content_hash) "
+    "VALUES ('a.docx', 'a.docx', '/uploads/a.docx', 10, 'abc')",
+    "INSERT INTO chat_sessions (session_id, file_id) VALUES ('legacy-session', 1)",
+]
+
+class TestSchemaUpgrade:
+    
+    @pytest.fixture
+    def legacy_engine(self, tmp_path):
+        """Engine on a database file laid out like the first release, with one file and one session."""
+        engine = create_engine(f"sqlite:///{tmp_path / 'legacy.db'}")
+        with engine.begin() as conn:
+            for statement in LEGACY_SCHEMA:
+                conn.exec_driver_sql(statement)
+        yield engine
+        engine.dispose()
+    
+    def test_create_tables_adds_missing_columns_and_indexes(self, legacy_engine):
+        """Test that an old database gains the current columns, with server defaults filled in."""
+        create_tables(legacy_engine)
+        
+        inspector = inspect(legacy_engine)
+        assert {"suggested_titles", "hash_algo"} <= {c["name"] for c in inspector.get_columns("uploaded_files")}
+        assert "ix_chat_sessions_session_id" in {i["name"] for i in inspector.get_indexes("chat_sessions")}
+        with legacy_engine.connect() as conn:
+            assert conn.exec_driver_sql("SELECT history_count FROM chat_sessions").scalar_one() == 0
+        
+        # A second run finds nothing to do
+        create_tables(legacy_engine)
+    
+    def test_create_tables_fails_loudly(self, legacy_engine):
+        """Test that an index the existing rows violate stops the upgrade instead of being skipped."""
+        with legacy_engine.begin() as conn:
+            conn.exec_driver_sql("INSERT INTO chat_sessions (session_id, file_id) VALUES ('legacy-session', 1)")
+        
+        with pytest.raises(IntegrityError):
+            create_tables(legacy_engine)
\ No newline at end of file
@@ -0,0 +1,399 @@
+import asyncio
+import os
+import re
+import threading
+import httpx
+import numpy as np
+import pytest
+from unittest.mock import Mock
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+import backend.main
+from backend.database import Base, get_db
+from backend import ann_index, embedding_service, llm_service, rag_service
+from backend.config import settings
+from backend.llm_service import FALLBACK_MODELS
+from backend.models import ChatMessage, ChatSession, MessageContext, UploadedFile
+from backend.rag_service import RAGService, embedding_matrix_path, embedding_scales_path, invalidate_file_cache
+
+DOCX_MIME = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+
+# Each embedding dimension counts one topic's words, so texts on the same topic embed close together
+TOPICS = [
+    {"security", "password", "passwords", "access", "encryption"},
+    {"revenue", "sales", "profit", "quarter"},
+    {"annual", "leave", "holiday", "vacation"},
+]
+
+# Ten words per paragraph, so with chunk_size 10 each paragraph is one chunk
+DOCUMENT = [
+    "Security policy requires password rotation and access protected by encryption.",
+    "Revenue grew this quarter because sales and profit both rose.",
+    "Annual leave gives staff members holiday allowance and vacation days.",
+]
+
+# Enough chunks to train the per-file IVF-PQ index once its threshold is lowered
+LARGE_DOCUMENT = DOCUMENT * 100
+
+LLM_REPLY = "Here is what the document says about that."
+
+def fake_embedding(text: str) -> list:
+    words = re.findall(r"[a-z]+", text.lower())
+    return [float(sum(word in topic for word in words)) for topic in TOPICS] + [0.1]
+
+def write_onnx_embedder(model_dir):
+    """Export a model.onnx and tokenizer.json that embed like fake_embedding, as token means."""
+    onnx = pytest.importorskip("onnx")
+    pytest.importorskip("onnxruntime")
+    tokenizers = pytest.importorskip("tokenizers")
+    
+    # One token per topic word; every other token (and padding) maps to the constant dimension
+    words = sorted(set().union(*TOPICS))
+    vocab = {"[PAD]": 0, "[UNK]": 1, **{word: i + 2 for i, word in enumerate(words)}}
+    table = np.zeros((len(vocab), len(TOPICS) + 1), dtype=np.float32)
+    table[:2, -1] = 0.1
+    for word, token_id in vocab.items():
+        for topic_idx, topic in enumerate(TOPICS):
+            if word in topic:
+                table[token_id, topic_idx] = 1.0
+    
+    tokenizer = tokenizers.Tokenizer(tokenizers.models.WordLevel(vocab, unk_token="[UNK]"))
+    tokenizer.normalizer = tokenizers.normalizers.Lowercase()
+    tokenizer.pre_tokenizer = tokenizers.pre_tokenizers.Whitespace()
+    tokenizer.save(str(model_dir / "tokenizer.json"))
+    
+    helper = onnx.helper
+    graph = helper.make_graph(
+        [helper.make_node("Gather", ["embeddings", "input_ids"], ["token_embeddings"])],
+        "embedder",
+        [
+            helper.make_tensor_value_info("input_ids", onnx.TensorProto.INT64, ["batch", "sequence"]),
+            helper.make_tensor_value_info("attention_mask", onnx.TensorProto.INT64, ["batch", "sequence"]),
+        ],
+        [helper.make_tensor_value_info("token_embeddings", onnx.TensorProto.FLOAT, ["batch", "sequence", table.shape[1]])],
+        initializer=[onnx.numpy_helper.from_array(table, "embeddings")]
+    )
+    onnx.save(helper.make_model(graph, opset_imports=[helper.make_opsetid("", 13)]), str(model_dir / "model.onnx"))
+
+def api_response(payload, status_code=200):
+    response = Mock()
+    response.status_code = status_code
+    response.json.return_value = payload
+    response.text = str(payload)
+    return response
+
+class TestEmbeddingBackend:
+    
+    @pytest.fixture(autouse=True)
+    def _embedding_backend(self, monkeypatch, docx_factory, temp_upload_dir):
+        """Serve the app from RAGService, with the Hugging Face APIs answered in-process."""
+        self.docx_factory = docx_factory
+        monkeypatch.setattr(settings, "HF_API_KEY", "test-key")
+        monkeypatch.setattr(backend.main.document_processor, "chunk_size", 10)
+        monkeypatch.setattr(backend.main.document_processor, "chunk_overlap", 0)
+        self.service = RAGService()
+        monkeypatch.setattr(backend.main, "rag_service", self.service)
+        
+        self.embedding_posts = []
+        self.sync_embedding_posts = []
+        self.llm_posts = []
+        self.failing_models = set()
+        self.in_flight = self.max_in_flight = 0
+        
+        async def embedding_post(url, headers=None, json=None):
+            self.embedding_posts.append(json["inputs"])
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            # Yield to the loop, so requests sent together are in flight together
+            await asyncio.sleep(0.01)
+            self.in_flight -= 1
+            return api_response([fake_embedding(text) for text in json["inputs"]])
+        
+        def sync_embedding_post(url, headers=None, json=None, timeout=None):
+            self.sync_embedding_posts.append(json["inputs"])
+            return api_response([fake_embedding(text) for text in json["inputs"]])
+        
+        async def llm_post(url, headers=None, json=None):
+            model = url.split("/models/", 1)[1]
+            self.llm_posts.append((model, json["inputs"]))
+            if model in self.failing_models:
+                return api_response({"error": "Model is currently loading"}, status_code=503)
+            return api_response([{"generated_text": LLM_REPLY}])
+        
+        monkeypatch.setattr(embedding_service._async_client, "post", embedding_post)
+        monkeypatch.setattr(self.service.embedding_service._session, "post", sync_embedding_post)
+        monkeypatch.setattr(llm_service._client, "post", llm_post)
+    
+    @pytest.fixture
+    def uploaded_file_id(self, client):
+        """Id of DOCUMENT uploaded through the API."""
+        response = client.post("/api/upload", files={"files": ("policy.docx", self.docx_factory(DOCUMENT), DOCX_MIME)})
+        return response.json()["uploaded_files"][0]["id"]
+    
+    @pytest.fixture
+    def chat_session_id(self, client, uploaded_file_id):
+        """Id of a chat session started on the uploaded file."""
+        return client.post("/api/chat/start", data={"file_id": uploaded_file_id}).json()["session_id"]
+    
+    @pytest.fixture
+    def large_file_id(self, client, monkeypatch):
+        """Id of LARGE_DOCUMENT, uploaded with the ANN index threshold lowered to its size."""
+        pytest.importorskip("faiss")
+        monkeypatch.setattr(ann_index, "INDEX_THRESHOLD", len(LARGE_DOCUMENT))
+        response = client.post("/api/upload", files={"files": ("large.docx", self.docx_factory(LARGE_DOCUMENT), DOCX_MIME)})
+        return response.json()["uploaded_files"][0]["id"]
+    
+    def test_upload_embeds_chunks_with_async_client(self, client, uploaded_file_id):
+        """Test that an upload embeds its chunks in one request on the shared async client."""
+        assert self.embedding_posts == [DOCUMENT]
+        assert self.sync_embedding_posts == []
+        assert os.path.exists(embedding_matrix_path(uploaded_file_id))
+    
+    def test_failed_embedding_leaves_no_file_row(self, client, test_db, monkeypatch):
+        """Test that a file whose embedding fails isn't saved by the next file's commit."""
+        aget_embeddings_batch = self.service.embedding_service.aget_embeddings_batch
+        calls = []
+        
+        async def fail_first(texts):
+            calls.append(texts)
+            if len(calls) == 1:
+                raise ValueError("HF_API_KEY not provided")
+            return await aget_embeddings_batch(texts)
+        
+        monkeypatch.setattr(self.service.embedding_service, "aget_embeddings_batch", fail_first)
+        files = [
+            ("files", ("failing.docx", self.docx_factory(DOCUMENT[:1]), DOCX_MIME)),
+            ("files", ("policy.docx", self.docx_factory(DOCUMENT), DOCX_MIME)),
+        ]
+        data = client.post("/api/upload", files=files).json()
+        
+        assert data["success_count"] == 1
+        assert "failing.docx: Failed to generate embeddings" in data["errors"]
+        assert test_db.query(UploadedFile.original_filename).all() == [("policy.docx",)]
+    
+    def test_upload_with_no_embeddings_fails(self, client, test_db, monkeypatch):
+        """Test that a file none of whose chunks got an embedding is reported as failed and not stored."""
+        async def unusable_post(url, headers=None, json=None):
+            return api_response({"error": "unexpected format"})
+        
+        monkeypatch.setattr(embedding_service._async_client, "post", unusable_post)
+        data = client.post("/api/upload", files={"files": ("policy.docx", self.docx_factory(DOCUMENT), DOCX_MIME)}).json()
+        
+        assert data["success_count"] == 0
+        assert "policy.docx: Failed to generate embeddings" in data["errors"]
+        assert test_db.query(UploadedFile).count() == 0
+    
+    def test_upload_sends_embedding_batches_concurrently(self, client, test_db, monkeypatch):
+        """Test that an upload's batches overlap, up to the concurrency limit, and are stored in chunk order."""
+        monkeypatch.setattr(self.service.embedding_service, "batch_size", 1)
+        monkeypatch.setattr(self.service.embedding_service, "concurrency", 2)
+        
+        response = client.post("/api/upload", files={"files": ("policy.docx", self.docx_factory(DOCUMENT), DOCX_MIME)})
+        file_id = response.json()["uploaded_files"][0]["id"]
+        
+        assert sorted(self.embedding_posts) == sorted([text] for text in DOCUMENT)
+        assert self.max_in_flight == 2
+        
+        # Each chunk kept its own embedding, so a question still finds its chunk
+        session_id = client.post("/api/chat/start", data={"file_id": file_id}).json()["session_id"]
+        client.post("/api/chat", json={"session_id": session_id, "message": "When is vacation allowed?"})
+        top_context = test_db.query(MessageContext).filter(MessageContext.rank == 0).one()
+        assert top_context.chunk.chunk_text == DOCUMENT[2]
+    
+    def test_chat_scores_memory_mapped_int8_matrix(self, client, test_db, uploaded_file_id, chat_session_id, monkeypatch):
+        """Test that chat scores the file's int8 matrix and per-row scales straight from INDEX_DIR."""
+        stored = np.load(embedding_matrix_path(uploaded_file_id))
+        assert stored.dtype == np.int8 and stored.shape == (len(DOCUMENT), len(TOPICS) + 1)
+        assert np.load(embedding_scales_path(uploaded_file_id)).shape == (len(DOCUMENT),)
+        
+        scored = []
+        batch_similarities = self.service.embedding_service.batch_similarities
+        
+        def tracked_similarities(query_embedding, chunk_matrix, row_scales=None):
+            scored.append((chunk_matrix, row_scales))
+            return batch_similarities(query_embedding, chunk_matrix, row_scales)
+        
+        monkeypatch.setattr(self.service.embedding_service, "batch_similarities", tracked_similarities)
+        invalidate_file_cache(uploaded_file_id)
+        client.post("/api/chat", json={"session_id": chat_session_id, "message": "What was the revenue?"})
+        
+        (chunk_matrix, row_scales), = scored
+        assert isinstance(chunk_matrix, np.memmap) and chunk_matrix.dtype == np.int8
+        assert row_scales is not None
+        top_context = test_db.query(MessageContext).filter(MessageContext.rank == 0).one()
+        assert top_context.chunk.chunk_text == DOCUMENT[1]
+        # Close to the float32 cosine of the query with that chunk
+        query, chunk = np.array(fake_embedding("What was the revenue?")), np.array(fake_embedding(DOCUMENT[1]))
+        assert top_context.similarity == pytest.approx(query @ chunk / np.linalg.norm(query) / np.linalg.norm(chunk), abs=0.02)
+    
+    def test_chat_searches_ann_index_on_large_files(self, client, test_db, large_file_id, monkeypatch):
+        """Test that chat on a file past the threshold searches its FAISS index instead of scanning."""
+        searches = []
+        search_index = rag_service.search_index
+        
+        def tracked_search(index, query_vec, top_k):
+            searches.append(index)
+            return search_index(index, query_vec, top_k)
+        
+        monkeypatch.setattr(rag_service, "search_index", tracked_search)
+        monkeypatch.setattr(self.service.embedding_service, "find_similar_chunks", Mock(side_effect=AssertionError("scanned")))
+        session_id = client.post("/api/chat/start", data={"file_id": large_file_id}).json()["session_id"]
+        client.post("/api/chat", json={"session_id": session_id, "message": "How are passwords protected?"})
+        
+        assert len(searches) == 1
+        top_context = test_db.query(MessageContext).filter(MessageContext.rank == 0).one()
+        assert top_context.chunk.chunk_text == DOCUMENT[0]
+    
+    def test_large_file_index_is_compressed_and_deleted_with_file(self, client, large_file_id):
+        """Test that the ANN index is IVF-PQ, with codes smaller than the float32 rows, and goes with its file."""
+        import faiss
+        path = ann_index.index_path(large_file_id)
+        index = faiss.read_index(path)
+        
+        assert isinstance(index, faiss.IndexIVFPQ)
+        assert index.ntotal == len(LARGE_DOCUMENT)
+        assert index.code_size < (len(TOPICS) + 1) * 4
+        
+        assert client.delete(f"/api/files/{large_file_id}").status_code == 200
+        assert not os.path.exists(path)
+    
+    def test_chat_answers_from_llm_with_retrieved_context(self, client, test_db, chat_session_id):
+        """Test that a chat turn is answered by the LLM, with the closest chunk first in its prompt."""
+        response = client.post("/api/chat", json={"session_id": chat_session_id, "message": "How are passwords protected?"})
+        
+        assert response.status_code == 200
+        assert response.json()["response"] == LLM_REPLY
+        
+        _, prompt = self.llm_posts[-1]
+        assert f"Context from documents:\n{DOCUMENT[0]}" in prompt
+        top_context = test_db.query(MessageContext).filter(MessageContext.rank == 0).one()
+        assert top_context.chunk.chunk_text == DOCUMENT[0]
+        
+        history = client.get(f"/api/chat/{chat_session_id}/history").json()
+        assert [message["content"] for message in history] == ["How are passwords protected?", LLM_REPLY]
+    
+    def test_chat_falls_back_to_next_model_and_keeps_it(self, client, chat_session_id):
+        """Test that a failing model is skipped, and the model that answered is tried first next turn."""
+        self.failing_models.add(FALLBACK_MODELS[0])
+        
+        response = client.post("/api/chat", json={"session_id": chat_session_id, "message": "What was the revenue?"})
+        assert response.json()["response"] == LLM_REPLY
+        assert [model for model, _ in self.llm_posts] == FALLBACK_MODELS[:2]
+        
+        client.post("/api/chat", json={"session_id": chat_session_id, "message": "And the profit?"})
+        assert self.llm_posts[2][0] == FALLBACK_MODELS[1]
+    
+    def test_follow_up_retrieves_with_session_history(self, client, test_db, chat_session_id):
+        """Test that a follow-up with no topic of its own retrieves what the session was asking about."""
+        client.post("/api/chat", json={"session_id": chat_session_id, "message": "How are passwords protected?"})
+        client.post("/api/chat", json={"session_id": chat_session_id, "message": "Tell me more"})
+        
+        follow_up = test_db.query(ChatMessage.id).filter(
+            ChatMessage.session_id == chat_session_id, ChatMessage.message_type == "assistant"
+        ).order_by(ChatMessage.id.desc()).limit(1).scalar_subquery()
+        contexts = test_db.query(MessageContext).filter(MessageContext.message_id == follow_up).order_by(MessageContext.rank).all()
+        # On its own "Tell me more" scores every chunk the same; the history puts the security chunk first
+        assert contexts[0].chunk.chunk_text == DOCUMENT[0]
+        assert contexts[0].similarity > contexts[1].similarity
+        
+        # The running mean keeps folding in the raw queries
+        assert test_db.query(ChatSession.history_count).filter(ChatSession.session_id == chat_session_id).scalar() == 2
+    
+    def test_chat_embeds_query_while_loading_session(self, client, chat_session_id, monkeypatch):
+        """Test that the session lookup runs while the query embedding request is still in flight."""
+        lookup_started = threading.Event()
+        load_session_history = self.service._load_session_history
+        
+        def tracked_load(db, session_id):
+            lookup_started.set()
+            return load_session_history(db, session_id)
+        
+        overlapped = []
+        
+        async def embedding_post(url, headers=None, json=None):
+            # Only answer once the lookup has begun; run one after the other, this waits out the timeout
+            overlapped.append(await asyncio.to_thread(lookup_started.wait, 5))
+            return api_response([fake_embedding(text) for text in json["inputs"]])
+        
+        monkeypatch.setattr(self.service, "_load_session_history", tracked_load)
+        monkeypatch.setattr(embedding_service._async_client, "post", embedding_post)
+        
+        response = client.post("/api/chat", json={"session_id": chat_session_id, "message": "How are passwords protected?"})
+        
+        assert response.json()["response"] == LLM_REPLY
+        assert overlapped == [True]
+    
+    @pytest.fixture
+    def per_request_sessions(self, tmp_path):
+        """A database file with a Session per request, so concurrent requests don't share one."""
+        engine = create_engine(f"sqlite:///{tmp_path / 'chat.db'}", connect_args={"check_same_thread": False})
+        Base.metadata.create_all(bind=engine)
+        make_session = sessionmaker(bind=engine, autoflush=False)
+        
+        def override_get_db():
+            db = make_session()
+            try:
+                yield db
+            finally:
+                db.close()
+        
+        backend.main.app.dependency_overrides[get_db] = override_get_db
+        yield make_session
+        backend.main.app.dependency_overrides.pop(get_db, None)
+        engine.dispose()
+    
+    def test_concurrent_chats_share_one_embedding_request(self, per_request_sessions, monkeypatch):
+        """Test that questions arriving within max_wait of each other are embedded in one API request."""
+        monkeypatch.setattr(self.service.embedding_batcher, "max_wait", 0.2)
+        questions = ["How are passwords protected?", "What was the revenue?"]
+        
+        async def chat_concurrently():
+            transport = httpx.ASGITransport(app=backend.main.app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://test") as http:
+                upload = await http.post("/api/upload", files={"files": ("policy.docx", self.docx_factory(DOCUMENT), DOCX_MIME)})
+                file_id = upload.json()["uploaded_files"][0]["id"]
+                session_ids = [
+                    (await http.post("/api/chat/start", data={"file_id": file_id})).json()["session_id"]
+                    for _ in questions
+                ]
+                self.embedding_posts.clear()
+                return await asyncio.gather(*(
+                    http.post("/api/chat", json={"session_id": session_id, "message": question})
+                    for session_id, question in zip(session_ids, questions)
+                ))
+        
+        responses = asyncio.run(chat_concurrently())
+        
+        assert [response.json()["response"] for response in responses] == [LLM_REPLY, LLM_REPLY]
+        assert len(self.embedding_posts) == 1
+        assert sorted(self.embedding_posts[0]) == sorted(questions)
+        assert self.sync_embedding_posts == []
+        # Each answer was still built from its own question's chunk
+        prompts = [prompt for _, prompt in self.llm_posts]
+        assert any(f"Context from documents:\n{DOCUMENT[0]}" in prompt for prompt in prompts)
+        assert any(f"Context from documents:\n{DOCUMENT[1]}" in prompt for prompt in prompts)
+    
+    def test_chat_embeds_with_local_onnx_model(self, client, test_db, tmp_path, monkeypatch):
+        """Test that with EMBEDDING_ONNX_DIR set, uploads and chat embed locally and never call the API."""
+        write_onnx_embedder(tmp_path)
+        monkeypatch.setattr(settings, "EMBEDDING_ONNX_DIR", str(tmp_path))
+        service = RAGService()
+        assert service.embedding_service.local_embedder is not None
+        monkeypatch.setattr(backend.main, "rag_service", service)
+        
+        response = client.post("/api/upload", files={"files": ("policy.docx", self.docx_factory(DOCUMENT), DOCX_MIME)})
+        session_id = client.post("/api/chat/start", data={"file_id": response.json()["uploaded_files"][0]["id"]}).json()["session_id"]
+        response = client.post("/api/chat", json={"session_id": session_id, "message": "How are passwords protected?"})
+        
+        assert response.json()["response"] == LLM_REPLY
+        assert self.embedding_posts == []
+        top_context = test_db.query(MessageContext).filter(MessageContext.rank == 0).one()
+        assert top_context.chunk.chunk_text == DOCUMENT[0]
+    
+    def test_chat_unknown_session(self, client, test_db):
+        """Test that a chat turn on a session that doesn't exist is a 404 and calls no model."""
+        response = client.post("/api/chat", json={"session_id": "missing", "message": "Hello there"})
+        
+        assert response.status_code == 404
+        assert self.llm_posts == []
\ No newline at end of file